@@ -0,0 +1,451 @@
+"""
+on-disk cache of the archive metadata downloaded by bpaingest, shared between
+the worker processes.
+
+each importer has a directory of snapshots, named by the time they were fetched.
+a snapshot is fetched under an exclusive lock on the importer, so a burst of
+jobs waits on a single download rather than each fetching the archive. jobs
+hold a shared lock on the snapshot they are using, and eviction skips any
+snapshot which is locked.
+
+the "prior" package and resource state derived from a snapshot depends only
+upon its contents, so it is memoized alongside the snapshots, keyed by a
+fingerprint of those contents. each worker process also holds the most
+recently used prior states in memory, along with an index of their packages
+and resources by linkage, which allows a submission to be checked against
+the archive without regenerating the archive's packages and resources.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager, suppress
+
+import pkg_resources
+from django.conf import settings
+
+from bpaingest.metadata import DownloadMetadata
+
+
+def bpaingest_version():
+    try:
+        return pkg_resources.get_distribution("bpaingest").version
+    except pkg_resources.DistributionNotFound:
+        return "unknown"
+
+
+def archive_version(cls):
+    """
+    the archive metadata for `cls` depends upon where it is fetched from, and
+    the version of bpaingest which fetches it
+    """
+    urls = list(getattr(cls, "metadata_urls", []))
+    for contextual_cls in getattr(cls, "contextual_classes", []):
+        urls += getattr(contextual_cls, "metadata_urls", [])
+    h = hashlib.sha1()
+    h.update(json.dumps([bpaingest_version(), sorted(urls)]).encode("utf8"))
+    return h.hexdigest()[:16]
+
+
+def cache_root():
+    return settings.VERIFICATION_ARCHIVE_CACHE_DIR
+
+
+def cache_dir(importer, cls):
+    return os.path.join(cache_root(), "{}-{}".format(importer, archive_version(cls)))
+
+
+@contextmanager
+def flocked(path, operation):
+    with open(path, "a") as fd:
+        fcntl.flock(fd, operation)
+        yield fd
+
+
+def is_fresh(created):
+    return time.time() - created < settings.VERIFICATION_ARCHIVE_CACHE_TTL
+
+
+def is_snapshot_name(name):
+    "snapshots are named by the time they were created"
+    try:
+        float(name)
+    except ValueError:
+        return False
+    return True
+
+
+def list_snapshots(key_dir):
+    "returns (created, path) for each snapshot in `key_dir`, newest first"
+    snapshots = []
+    for name in os.listdir(key_dir):
+        path = os.path.join(key_dir, name)
+        if not is_snapshot_name(name):
+            continue
+        created = float(name)
+        if os.path.isdir(path):
+            snapshots.append((created, path))
+    snapshots.sort(reverse=True)
+    return snapshots
+
+
+def open_fresh_snapshot(key_dir):
+    """
+    returns (path, lock_fd) for the newest unexpired snapshot in `key_dir`,
+    with a shared lock held upon it; or None if there is no such snapshot
+    """
+    for created, path in list_snapshots(key_dir):
+        if not is_fresh(created):
+            break
+        fd = open(path + ".lock", "a")
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        # the snapshot may have been evicted before we took the lock, in which
+        # case opening the lock recreated it
+        if os.path.isdir(path):
+            return path, fd
+        with suppress(OSError):
+            os.unlink(path + ".lock")
+        fd.close()
+    return None
+
+
+def directory_size(path):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            with suppress(OSError):
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+    return size
+
+
+def directory_fingerprint(path):
+    h = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            fpath = os.path.join(dirpath, filename)
+            h.update(os.path.relpath(fpath, path).encode("utf8") + b"\0")
+            with open(fpath, "rb") as fd:
+                for chunk in iter(lambda: fd.read(1 << 20), b""):
+                    h.update(chunk)
+    return h.hexdigest()
+
+
+def snapshot_fingerprint(path):
+    try:
+        with open(path + ".fingerprint") as fd:
+            return fd.read().strip()
+    except OSError:
+        return directory_fingerprint(path)
+
+
+def install_snapshot(key_dir, populate):
+    """
+    create a new snapshot in `key_dir`, calling `populate` with the path to
+    write its contents to. returns the snapshot as per `open_fresh_snapshot`.
+    """
+    staging = tempfile.mkdtemp(prefix="fetch-", dir=key_dir)
+    try:
+        fetch_path = os.path.join(staging, "metadata")
+        populate(fetch_path)
+        path = os.path.join(key_dir, "%.6f" % time.time())
+        with open(path + ".size", "w") as size_fd:
+            size_fd.write(str(directory_size(fetch_path)))
+        with open(path + ".fingerprint", "w") as fingerprint_fd:
+            fingerprint_fd.write(directory_fingerprint(fetch_path))
+        # lock the snapshot before it becomes visible, so it can't be evicted
+        lock_fd = open(path + ".lock", "a")
+        fcntl.flock(lock_fd, fcntl.LOCK_SH)
+        os.rename(fetch_path, path)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return path, lock_fd
+
+
+def fetch_snapshot(logger, importer, cls, key_dir):
+    """
+    download the archive metadata for `cls` into a new snapshot, returning
+    it as per `open_fresh_snapshot`
+    """
+    seed_dir = settings.VERIFICATION_ARCHIVE_SEED_DIR
+    if seed_dir:
+        # a local stand-in for the archive: a copy of its metadata for the
+        # importer if there is one, and otherwise an empty archive
+        source = os.path.join(seed_dir, importer)
+        if os.path.isdir(source):
+            return install_snapshot(key_dir, lambda path: copy_snapshot(source, path))
+        return install_snapshot(key_dir, lambda path: empty_archive(cls, path))
+    return install_snapshot(
+        key_dir, lambda path: DownloadMetadata(logger, cls, path=path)
+    )
+
+
+def empty_archive(cls, path):
+    """
+    a stand-in for the archive metadata of `cls` at `path`, holding no
+    submissions and no contextual metadata
+    """
+    os.makedirs(path)
+    for contextual_cls in getattr(cls, "contextual_classes", []):
+        os.mkdir(os.path.join(path, contextual_cls.name))
+    with open(os.path.join(path, "bpa-ingest.json"), "w") as fd:
+        json.dump({}, fd)
+    return path
+
+
+def seed_snapshot(importer, cls, source):
+    """
+    install a copy of the archive metadata in `source` as the newest snapshot
+    for `importer`, so jobs use it rather than fetching the archive. for
+    benchmarks and load tests, which run without access to the archive.
+    """
+    key_dir = cache_dir(importer, cls)
+    os.makedirs(key_dir, exist_ok=True)
+    with flocked(key_dir + ".lock", fcntl.LOCK_EX):
+        path, fd = install_snapshot(key_dir, lambda path: copy_snapshot(source, path))
+    fd.close()
+    return path
+
+
+@contextmanager
+def archive_snapshot(logger, importer, cls):
+    """
+    yields the path of an up-to-date copy of the archive metadata for `cls`,
+    downloading it if necessary. the snapshot is shared, and must not be
+    modified: use `copy_snapshot` to get a private copy.
+    """
+    key_dir = cache_dir(importer, cls)
+    os.makedirs(key_dir, exist_ok=True)
+    held = open_fresh_snapshot(key_dir)
+    if held is None:
+        with flocked(key_dir + ".lock", fcntl.LOCK_EX):
+            # another process may have fetched the archive while we waited
+            held = open_fresh_snapshot(key_dir)
+            if held is None:
+                logger.info("Fetching archive metadata for {}".format(importer))
+                held = fetch_snapshot(logger, importer, cls, key_dir)
+    path, fd = held
+    try:
+        yield path
+    finally:
+        fd.close()
+        evict_archive_cache()
+
+
+def copy_snapshot(snapshot_path, target):
+    shutil.copytree(snapshot_path, target, symlinks=True)
+    return target
+
+
+def remove_snapshot(path):
+    """
+    remove the snapshot at `path`, unless it is in use
+    """
+    with open(path + ".lock", "a") as fd:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        shutil.rmtree(path, ignore_errors=True)
+        for suffix in (".size", ".fingerprint", ".lock"):
+            with suppress(OSError):
+                os.unlink(path + suffix)
+    return True
+
+
+def snapshot_size(path):
+    try:
+        with open(path + ".size") as fd:
+            return int(fd.read())
+    except (OSError, ValueError):
+        return directory_size(path)
+
+
+def evict_archive_cache():
+    """
+    remove expired snapshots, and then the oldest snapshots until the cache
+    is within its size limit. snapshots which are in use are left alone.
+    """
+    root = cache_root()
+    if not os.path.isdir(root):
+        return
+    snapshots = []
+    for name in os.listdir(root):
+        key_dir = os.path.join(root, name)
+        if not os.path.isdir(key_dir):
+            continue
+        snapshots += list_snapshots(key_dir)
+        # clean up after any fetch which was interrupted, memoized prior state
+        # which hasn't been used recently, and the locks of evicted snapshots
+        for stale in os.listdir(key_dir):
+            stale_path = os.path.join(key_dir, stale)
+            if stale.endswith(".lock") and is_snapshot_name(stale[: -len(".lock")]):
+                # a snapshot being installed is locked just after its lock is
+                # created, so only locks which aren't new are removed
+                snapshot_path = stale_path[: -len(".lock")]
+                with suppress(OSError):
+                    if not os.path.isdir(snapshot_path) and not is_fresh(
+                        os.stat(stale_path).st_mtime
+                    ):
+                        remove_snapshot(snapshot_path)
+                continue
+            if not stale.startswith(("fetch-", "prior-")):
+                continue
+            with suppress(OSError):
+                if not is_fresh(os.stat(stale_path).st_mtime):
+                    if os.path.isdir(stale_path):
+                        shutil.rmtree(stale_path, ignore_errors=True)
+                    else:
+                        os.unlink(stale_path)
+
+    retained = []
+    for created, path in snapshots:
+        if is_fresh(created) or not remove_snapshot(path):
+            retained.append((created, path))
+
+    sizes = dict((path, snapshot_size(path)) for _, path in retained)
+    total = sum(sizes.values())
+    for created, path in sorted(retained):
+        if total <= settings.VERIFICATION_ARCHIVE_CACHE_MAX_SIZE:
+            break
+        if remove_snapshot(path):
+            total -= sizes[path]
+
+
+# prior states (and their indexes) recently used by this process
+process_prior_states = OrderedDict()
+PROCESS_PRIOR_STATES = 4
+
+
+def store_prior_state(memo_path, state):
+    "write `state` to `memo_path`; the caller holds the lock on the memo"
+    tmp_path = memo_path + ".tmp"
+    with open(tmp_path, "wb") as fd:
+        pickle.dump(state, fd, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, memo_path)
+
+
+def memoized_prior_state(snapshot_path, make_state, resource_linkage):
+    """
+    returns the prior state for the archive in `snapshot_path`, and its
+    linkage index, calling `make_state` only if the state hasn't already
+    been computed for an identical archive
+    """
+    memo_path = os.path.join(
+        os.path.dirname(snapshot_path),
+        "prior-{}.pickle".format(snapshot_fingerprint(snapshot_path)),
+    )
+    memo_key = (memo_path, tuple(resource_linkage))
+    if memo_key in process_prior_states:
+        process_prior_states.move_to_end(memo_key)
+        memo = process_prior_states[memo_key]
+        try:
+            os.utime(memo_path)
+        except FileNotFoundError:
+            # evicted from the cache, while this process held on to it
+            with flocked(memo_path + ".lock", fcntl.LOCK_EX):
+                if not os.path.exists(memo_path):
+                    store_prior_state(memo_path, memo[0])
+        return memo
+
+    # jobs which arrive together wait on the first to compute the state
+    with flocked(memo_path + ".lock", fcntl.LOCK_EX):
+        try:
+            with open(memo_path, "rb") as fd:
+                state = pickle.load(fd)
+            # the memo may be evicted once read, but the state is in hand
+            with suppress(FileNotFoundError):
+                os.utime(memo_path)
+        except FileNotFoundError:
+            state = dict((t, dict(v)) for (t, v) in make_state().items())
+            store_prior_state(memo_path, state)
+
+    memo = state, linkage_index(state, resource_linkage)
+    process_prior_states[memo_key] = memo
+    while len(process_prior_states) > PROCESS_PRIOR_STATES:
+        process_prior_states.popitem(last=False)
+    return memo
+
+
+def package_linkage(package_obj, resource_linkage):
+    return tuple(package_obj[t] for t in resource_linkage)
+
+
+def linkage_index(state, resource_linkage):
+    """
+    index the packages and resources in `state` by their linkage tuple
+    """
+    index = {}
+    for data_type, data in state.items():
+        packages = defaultdict(list)
+        for package_obj in data.get("packages", []):
+            packages[package_linkage(package_obj, resource_linkage)].append(package_obj)
+        resources = defaultdict(list)
+        for resource in data.get("resources", []):
+            resources[resource[0]].append(resource)
+        index[data_type] = {"packages": dict(packages), "resources": dict(resources)}
+    return index
+
+
+def linkage_subset(index, submission_state, resource_linkage):
+    """
+    the packages and resources generated from a submission, along with the
+    packages and resources in the archive which share their linkage. linkage
+    QC over this subset finds the same problems involving the submission as
+    QC over the whole archive with the submission added.
+    """
+    subset = {}
+    for data_type, data in submission_state.items():
+        archive = index.get(data_type, {"packages": {}, "resources": {}})
+        packages = list(data["packages"])
+        resources = list(data["resources"])
+        package_ids = set(t["id"] for t in packages)
+        resource_ids = set(t[2]["id"] for t in resources)
+        package_linkages = set(package_linkage(t, resource_linkage) for t in packages)
+        resource_linkages = set(t[0] for t in resources)
+        for linkage in package_linkages | resource_linkages:
+            packages += [
+                t
+                for t in archive["packages"].get(linkage, [])
+                if t["id"] not in package_ids
+            ]
+        for linkage in package_linkages:
+            resources += [
+                t
+                for t in archive["resources"].get(linkage, [])
+                if t[2]["id"] not in resource_ids
+            ]
+        packages.sort(key=lambda x: x["id"])
+        resources.sort(key=lambda x: x[2]["id"])
+        subset[data_type] = {"packages": packages, "resources": resources}
+    return subset
+
+
+def submission_changes(index, state, resource_linkage):
+    """
+    the packages and resources of `state` which aren't in the archive (of
+    which `index` is the linkage index) as they are: for the archive with a
+    submission added, those of the submission. either way of generating a
+    submission's packages and resources gives the same changes.
+    """
+    changes = {}
+    for data_type, data in state.items():
+        archive = index.get(data_type, {"packages": {}, "resources": {}})
+        archived = archive["packages"]
+        packages = [
+            t
+            for t in data["packages"]
+            if t not in archived.get(package_linkage(t, resource_linkage), [])
+        ]
+        resources = [
+            t for t in data["resources"] if t not in archive["resources"].get(t[0], [])
+        ]
+        if packages or resources:
+            changes[data_type] = {"packages": packages, "resources": resources}
+    return changes
@@ -0,0 +1,138 @@
+"""
+batches of submissions, verified together.
+
+a batch is a set of spreadsheets and MD5 files, each spreadsheet paired with
+the MD5 file named alike up to the last underscore (for example
+"79639_GAP_AGRF_PAE47351_metadata.xlsx" and
+"79639_GAP_AGRF_PAE47351_checksums.md5"). each pair is a job, whose quick
+checks run as for any other job; the bpaingest diff is then run once for
+the whole batch, with every verified spreadsheet added to the archive.
+
+the jobs of a batch are recorded in redis, for the batch status API.
+"""
+
+import json
+import os
+import zipfile
+
+from django.conf import settings
+
+from .models import VerificationJob, redis_client
+from .uploads import UploadError, max_size
+
+
+def batch_key(batch_id):
+    return "bpaworkflow:batch:{}".format(batch_id)
+
+
+def pair_name(filename):
+    return os.path.splitext(filename)[0].rsplit("_", 1)[0]
+
+
+def pair_files(names):
+    """
+    returns {pair name: {"xlsx": filename, "md5": filename}} for the
+    filenames in `names`, raising UploadError if any file is left unpaired
+    """
+    pairs = {}
+    for name in names:
+        kind = os.path.splitext(name)[1][1:].lower()
+        pair = pairs.setdefault(pair_name(name), {})
+        if kind in pair:
+            raise UploadError(
+                "more than one {} file for {}".format(kind, pair_name(name))
+            )
+        pair[kind] = name
+    unpaired = sorted(
+        name
+        for pair in pairs.values()
+        if set(pair) != {"xlsx", "md5"}
+        for name in pair.values()
+    )
+    if unpaired:
+        raise UploadError("unpaired files: {}".format(", ".join(unpaired)))
+    if len(pairs) > settings.VERIFICATION_BATCH_MAX_SUBMISSIONS:
+        raise UploadError(
+            "at most {} submissions may be made in a batch".format(
+                settings.VERIFICATION_BATCH_MAX_SUBMISSIONS
+            )
+        )
+    return pairs
+
+
+def check_batch_files(sizes):
+    """
+    raises UploadError if there are more files than a batch may have, or any
+    of them is too large; `sizes` is [(filename, size)]. this is checked
+    before any of the files are stored.
+    """
+    if len(sizes) > 2 * settings.VERIFICATION_BATCH_MAX_SUBMISSIONS:
+        raise UploadError(
+            "at most {} submissions may be made in a batch".format(
+                settings.VERIFICATION_BATCH_MAX_SUBMISSIONS
+            )
+        )
+    for name, size in sizes:
+        if size > max_size(name):
+            raise UploadError("{} is too large".format(name))
+
+
+def batch_files(files):
+    """
+    yields (filename, chunks) for each file of a batch, which is either a zip
+    archive (the `zip` part of `files`) or a set of `xlsx` and `md5` parts
+    """
+    if "zip" in files:
+        try:
+            zf = zipfile.ZipFile(files["zip"])
+        except zipfile.BadZipFile:
+            raise UploadError("invalid zip file")
+        with zf:
+            members = []
+            for info in zf.infolist():
+                name = os.path.basename(info.filename)
+                # folders, and the resource forks macOS adds to zip files
+                if info.is_dir() or name.startswith(".") or "__MACOSX" in info.filename:
+                    continue
+                members.append((name, info))
+            # the sizes are as the zip file declares them; the files are also
+            # limited as they are stored
+            check_batch_files([(name, info.file_size) for name, info in members])
+            for name, info in members:
+                with zf.open(info) as fd:
+                    yield name, iter(lambda: fd.read(1 << 20), b"")
+        return
+    uploaded = files.getlist("xlsx") + files.getlist("md5")
+    check_batch_files([(t.name, t.size) for t in uploaded])
+    for t in uploaded:
+        yield t.name, t.chunks()
+
+
+def record_batch(batch_id, importer, jobs):
+    "record the jobs of a batch, {pair name: job uuid}"
+    redis_client.set(
+        batch_key(batch_id),
+        json.dumps({"importer": importer, "jobs": jobs}),
+        ex=settings.VERIFICATION_STATUS_TTL,
+    )
+
+
+def batch_status(batch_id):
+    """
+    the status of each job in the batch, and whether they are all complete;
+    or None if there is no such batch
+    """
+    batch = redis_client.get(batch_key(batch_id))
+    if batch is None:
+        return None
+    batch = json.loads(batch.decode("utf8"))
+    submissions = dict(
+        (name, dict(submission_id=job_uuid, **VerificationJob.get_status(job_uuid)))
+        for name, job_uuid in batch["jobs"].items()
+    )
+    return {
+        "batch_id": batch_id,
+        "importer": batch["importer"],
+        "complete": all(t["complete"] for t in submissions.values()),
+        "submissions": submissions,
+    }
@@ -1,4 +1,10 @@
+import logging
+import time
+
+import redis
 from celery import Celery
+from celery.signals import before_task_publish, worker_process_init, worker_ready
+from django.conf import settings
 
 # set the default Django settings module for the 'celery' program.
 # os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'proj.settings')
@@ -14,7 +20,74 @@ app.config_from_object("django.conf:settings", namespace="CELERY")
 # Load task modules from all registered Django app configs.
 app.autodiscover_tasks()
 
+logger = logging.getLogger("rainbow")
+
 
 @app.task(bind=True)
 def debug_task(self):
     print("Request: {0!r}".format(self.request))
+
+
+@before_task_publish.connect
+def stamp_sent_at(headers=None, **kwargs):
+    """
+    record when each task is queued, so the time it waits for a worker can be
+    measured; the header is available to the task as `self.request.sent_at`
+    """
+    if headers is not None:
+        headers.setdefault("sent_at", time.time())
+
+
+def active_importers():
+    "the slugs and classes of the importers which can be verified"
+    from . import registry
+    from .views import has_its_own_active_ingest
+
+    return [
+        (info["slug"], info["cls"])
+        for info in registry.metadata_info()
+        if has_its_own_active_ingest(info["cls"])
+    ]
+
+
+@worker_process_init.connect
+def warm_worker_process(**kwargs):
+    """
+    load the importers, and compile their spreadsheet schemas and MD5 filename
+    matchers, as each worker process starts rather than in the first job for each
+    """
+    if not settings.VERIFICATION_WARM_IMPORTERS:
+        return
+    from .validate import warm_caches
+
+    warm_caches(cls for _, cls in active_importers())
+
+
+@worker_ready.connect
+def warm_archive_cache(**kwargs):
+    """
+    fetch the archive metadata for each recently used importer when a worker
+    starts. workers started together (after a deploy, or when scaling up) queue
+    the fetches once, on the "warm" queue.
+    """
+    if not settings.VERIFICATION_WARM_ARCHIVE:
+        return
+    from .models import redis_client
+    from .tasks import prime_archive_cache, recent_importers
+
+    recent = recent_importers(settings.VERIFICATION_WARM_ARCHIVE_RECENT)
+    for slug, _ in active_importers():
+        if slug not in recent:
+            continue
+        try:
+            queued = redis_client.set(
+                "bpaworkflow:warm:{}".format(slug),
+                1,
+                nx=True,
+                ex=settings.VERIFICATION_WARM_ARCHIVE_INTERVAL,
+            )
+        except redis.RedisError as e:
+            logger.error("Unable to warm archive cache: %s" % (repr(e)))
+            return
+        if queued:
+            prime_archive_cache.delay(slug)
@@ -0,0 +1,245 @@
+import json
+import os
+import shutil
+import statistics
+import tempfile
+
+import redis
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test.utils import override_settings
+
+from bpaworkflow import registry, resultcache, uploads
+from bpaworkflow.archive import empty_archive, seed_snapshot
+from bpaworkflow.celery import app
+from bpaworkflow.models import VerificationJob, redis_client
+from bpaworkflow.synthetic import synthetic_submission
+from bpaworkflow.tasks import make_pipeline
+
+STAGES = ("setup", "spreadsheet", "md5", "diff", "complete")
+
+
+def default_template(name):
+    return os.path.join(settings.WEBAPP_ROOT, "tests", "test_data", name)
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the verification pipeline with synthetic submissions, "
+        "reporting the throughput and memory use of each stage"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--importer",
+            default="gap-ont-promethion",
+            help="slug of the importer the template submission is for",
+        )
+        parser.add_argument(
+            "--xlsx",
+            default=default_template("79639_GAP_AGRF_PAE47351_metadata.xlsx"),
+            help="template spreadsheet",
+        )
+        parser.add_argument(
+            "--md5",
+            default=default_template("79639_GAP_AGRF_PAE47351_checksums.md5"),
+            help="template MD5 file",
+        )
+        parser.add_argument(
+            "--rows",
+            type=int,
+            nargs="+",
+            default=[100, 1000, 10000],
+            help="spreadsheet rows in each synthetic submission",
+        )
+        parser.add_argument(
+            "--repeat", type=int, default=3, help="runs of each submission"
+        )
+        parser.add_argument(
+            "--archive",
+            help="archive metadata to check against, as downloaded by bpaingest; "
+            "by default, an empty stand-in",
+        )
+        parser.add_argument(
+            "--redis-db",
+            type=int,
+            default=15,
+            help="redis database for the status of the benchmark's jobs, apart "
+            "from the application's",
+        )
+        parser.add_argument("--baseline", help="compare against this baseline")
+        parser.add_argument("--save-baseline", help="save the results as a baseline")
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=0.2,
+            help="fraction by which a stage may exceed the baseline",
+        )
+
+    def handle(self, *args, **options):
+        cls = registry.get_importer(options["importer"])
+        if cls is None:
+            raise CommandError("unknown importer: %s" % options["importer"])
+        if options["redis_db"] == int(settings.REDIS_DB):
+            raise CommandError(
+                "the application uses redis database %s" % options["redis_db"]
+            )
+
+        work_dir = tempfile.mkdtemp(prefix="bpaworkflow-benchmark-")
+        os.mkdir(os.path.join(work_dir, "log"))
+        # the tasks run in this process, in a private data directory; the status
+        # of their jobs is kept in a redis database of their own, and their
+        # measurements are kept out of the aggregate metrics
+        app.conf.task_always_eager = True
+        app.conf.task_eager_propagates = True
+        application_pool = redis_client.connection_pool
+        redis_client.connection_pool = redis.ConnectionPool(
+            host=settings.REDIS_HOST, db=options["redis_db"]
+        )
+        try:
+            with override_settings(
+                CELERY_DATADIR=work_dir,
+                VERIFICATION_UPLOAD_DIR=os.path.join(work_dir, "uploads"),
+                VERIFICATION_ARCHIVE_CACHE_DIR=os.path.join(work_dir, "archive"),
+                VERIFICATION_STAGE_METRICS=False,
+            ):
+                archive = options["archive"] or empty_archive(
+                    cls, os.path.join(work_dir, "stand-in")
+                )
+                seed_snapshot(options["importer"], cls, archive)
+                results = self.run_benchmarks(cls, work_dir, options)
+        finally:
+            redis_client.connection_pool.disconnect()
+            redis_client.connection_pool = application_pool
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        self.report(results)
+        if options["save_baseline"]:
+            with open(options["save_baseline"], "w") as fd:
+                json.dump(results, fd, indent=2, sort_keys=True)
+        if options["baseline"]:
+            with open(options["baseline"]) as fd:
+                baseline = json.load(fd)
+            regressions = self.compare(results, baseline, options["tolerance"])
+            if regressions:
+                raise CommandError(
+                    "%d measurement(s) exceed the baseline" % regressions
+                )
+
+    def run_benchmarks(self, cls, work_dir, options):
+        """
+        returns {"<importer>/<rows>/<stage>": median measurements}
+        """
+        results = {}
+        for rows in options["rows"]:
+            target = tempfile.mkdtemp(dir=work_dir)
+            xlsx_path, md5_path = synthetic_submission(
+                cls, options["xlsx"], options["md5"], rows, target
+            )
+            with open(md5_path) as fd:
+                md5_lines = sum(1 for _ in fd)
+            units = {"spreadsheet": rows, "md5": md5_lines, "diff": rows}
+            runs = [
+                self.run_pipeline(options["importer"], xlsx_path, md5_path)
+                for _ in range(options["repeat"])
+            ]
+            for stage in STAGES:
+                measured = [t[stage] for t in runs if stage in t]
+                if not measured:
+                    continue
+                wall = statistics.median(t["wall"] for t in measured)
+                result = {
+                    "wall": wall,
+                    "cpu": statistics.median(t["cpu"] for t in measured),
+                    "peak_rss": max(t["peak_rss"] for t in measured),
+                }
+                if stage in units:
+                    result["per_second"] = units[stage] / wall if wall else None
+                results["{}/{}/{}".format(options["importer"], rows, stage)] = result
+        return results
+
+    def run_pipeline(self, importer, xlsx_path, md5_path):
+        """
+        run the pipeline over a submission, returning the measurements of
+        each stage
+        """
+
+        def store(fpath):
+            with open(fpath, "rb") as fd:
+                return uploads.store_chunks(
+                    iter(lambda: fd.read(1 << 20), b""), float("inf")
+                )
+
+        # the job is rolled back once measured, so it is never seen in the job
+        # table; the tasks run in this process, within the transaction
+        with transaction.atomic():
+            job = VerificationJob.create(
+                importer=importer,
+                xlsx_name=os.path.basename(xlsx_path),
+                xlsx_sha256=store(xlsx_path),
+                md5_name=os.path.basename(md5_path),
+                md5_sha256=store(md5_path),
+            )
+            try:
+                job.set(complete=False)
+                make_pipeline().delay(job.uuid)
+                job.refresh_from_db()
+                for key in ("xlsx", "md5", "diff"):
+                    errors = job.state.get(key) or []
+                    if errors:
+                        self.stderr.write(
+                            "%s: %d error(s) reported, e.g. %s"
+                            % (key, len(errors), errors[0])
+                        )
+                return dict(
+                    (stage, job.state["metrics_{}".format(stage)])
+                    for stage in STAGES
+                    if "metrics_{}".format(stage) in job.state
+                )
+            finally:
+                transaction.set_rollback(True)
+                redis_client.delete(
+                    VerificationJob.status_key(job.uuid),
+                    resultcache.progress_key(job.uuid),
+                )
+
+    def report(self, results):
+        self.stdout.write(
+            "%-40s %10s %10s %12s %12s"
+            % ("stage", "wall (s)", "cpu (s)", "peak (MiB)", "units/s")
+        )
+        for key, result in sorted(results.items()):
+            per_second = result.get("per_second")
+            self.stdout.write(
+                "%-40s %10.3f %10.3f %12.1f %12s"
+                % (
+                    key,
+                    result["wall"],
+                    result["cpu"],
+                    result["peak_rss"] / (1 << 20),
+                    "%.1f" % per_second if per_second else "-",
+                )
+            )
+
+    def compare(self, results, baseline, tolerance):
+        """
+        report each measurement which exceeds the baseline by more than
+        `tolerance`, returning the number of them
+        """
+        regressions = 0
+        for key, result in sorted(results.items()):
+            if key not in baseline:
+                continue
+            for measure in ("wall", "cpu", "peak_rss"):
+                expected = baseline[key].get(measure)
+                if not expected:
+                    continue
+                ratio = result[measure] / expected
+                if ratio > 1 + tolerance:
+                    regressions += 1
+                    self.stdout.write(
+                        "%s %s: %.2fx baseline (%.3f, was %.3f)"
+                        % (key, measure, ratio, result[measure], expected)
+                    )
+        return regressions
@@ -0,0 +1,226 @@
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test.utils import override_settings
+
+from bpaworkflow import registry
+from bpaworkflow.archive import seed_snapshot
+from bpaworkflow.batches import pair_name
+from bpaworkflow.models import VerificationJob
+from bpaworkflow.tasks import (
+    archive_diff,
+    diff_error_message,
+    fabricate_metadata_info,
+    spreadsheet_errors,
+    unverified_message,
+    valid_filename,
+)
+from bpaworkflow.validate import verify_md5file, warm_caches
+
+
+def find_submissions(root):
+    """
+    yields (directory, pair name, xlsx path, md5 path, error) for each
+    submission under `root`. a spreadsheet is paired with the MD5 file in the
+    same directory named alike up to the last underscore; a file without a
+    pair is yielded with None in place of the other. the error is None, unless
+    the pair name is shared by more than one file of a kind.
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        pairs = {}
+        for filename in sorted(filenames):
+            if not valid_filename.match(filename):
+                continue
+            kind = os.path.splitext(filename)[1][1:].lower()
+            pairs.setdefault(pair_name(filename), {}).setdefault(kind, []).append(
+                os.path.join(dirpath, filename)
+            )
+        for name, pair in sorted(pairs.items()):
+            error = None
+            for kind, paths in sorted(pair.items()):
+                if len(paths) > 1:
+                    # as batches.pair_files, rather than choosing one of them
+                    error = "more than one {} file for {}: {}".format(
+                        kind, name, ", ".join(os.path.basename(t) for t in paths)
+                    )
+            yield (
+                dirpath,
+                name,
+                pair.get("xlsx", [None])[0],
+                pair.get("md5", [None])[0],
+                error,
+            )
+
+
+def check_submission(task):
+    """
+    verify a submission, as the pipeline would; runs in a pool process
+    """
+    importer, directory, name, xlsx_path, md5_path, error, diff = task
+    result = {
+        "directory": directory,
+        "name": name,
+        "importer": importer,
+        "xlsx": xlsx_path,
+        "md5": md5_path,
+    }
+    if error is not None:
+        result["error"] = error
+        return result
+    if xlsx_path is None or md5_path is None:
+        result["error"] = "no {} file".format("xlsx" if xlsx_path is None else "md5")
+        return result
+
+    logger = logging.getLogger("bulk_validate")
+    cls = registry.get_importer(importer)
+    started = time.monotonic()
+    temp_path = tempfile.mkdtemp(
+        prefix="bpaworkflow-bulk-", dir=settings.CELERY_DATADIR
+    )
+    try:
+        path_info = {}
+        for key, fpath in (("xlsx", xlsx_path), ("md5", md5_path)):
+            path_info[key] = os.path.join(temp_path, os.path.basename(fpath))
+            os.symlink(os.path.abspath(fpath), path_info[key])
+        # a job which is never saved, to hold the state the checks work from
+        job = VerificationJob(
+            importer=importer,
+            state={
+                "path_info": path_info,
+                "temp_path": temp_path,
+                "temp_metadata_info": fabricate_metadata_info(cls, temp_path),
+            },
+        )
+        result["xlsx_errors"] = spreadsheet_errors(job, cls)
+        result["md5_errors"] = verify_md5file(
+            logger, cls, path_info["md5"], max_errors=settings.VERIFICATION_MAX_ERRORS
+        )
+        if diff and (result["xlsx_errors"] or result["md5_errors"]):
+            result["diff"] = [unverified_message]
+        elif diff:
+            try:
+                result["diff"] = archive_diff(
+                    logger, importer, cls, [job], temp_path, "bulk.{}".format(name)
+                )[0]
+            except Exception:
+                logger.exception("There was a problem capturing packages or resources.")
+                result["diff"] = [diff_error_message]
+    except Exception as e:
+        result["error"] = repr(e)
+    finally:
+        shutil.rmtree(temp_path, ignore_errors=True)
+    result["seconds"] = time.monotonic() - started
+    return result
+
+
+def init_process(importer):
+    """
+    each pool process compiles the importer's checks before its first
+    submission; database connections aren't shared with the parent
+    """
+    connections.close_all()
+    warm_caches([registry.get_importer(importer)])
+
+
+class Command(BaseCommand):
+    help = (
+        "Verify the submissions in a directory tree, outside of the web "
+        "application and celery, writing the results as JSON lines"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("root", help="directory tree of xlsx and md5 files")
+        parser.add_argument("--importer", required=True, help="importer slug")
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=os.cpu_count(),
+            help="submissions verified at once",
+        )
+        parser.add_argument(
+            "--max-tasks-per-child",
+            type=int,
+            default=None,
+            help="replace each pool process after this many submissions",
+        )
+        parser.add_argument(
+            "--output", help="write results to this file, rather than stdout"
+        )
+        parser.add_argument(
+            "--no-diff",
+            action="store_false",
+            dest="diff",
+            help="don't check the submissions against the archive",
+        )
+        parser.add_argument(
+            "--archive",
+            help="check against this copy of the archive metadata, as downloaded "
+            "by bpaingest, rather than fetching it",
+        )
+        parser.add_argument(
+            "--work-dir",
+            default=tempfile.gettempdir(),
+            help="scratch space, and the archive metadata cache",
+        )
+
+    def handle(self, *args, **options):
+        importer = options["importer"]
+        cls = registry.get_importer(importer)
+        if cls is None:
+            raise CommandError("unknown importer: %s" % importer)
+        if not os.path.isdir(options["root"]):
+            raise CommandError("not a directory: %s" % options["root"])
+
+        work_dir = tempfile.mkdtemp(prefix="bpaworkflow-bulk-", dir=options["work_dir"])
+        os.mkdir(os.path.join(work_dir, "log"))
+        out = open(options["output"], "w") if options["output"] else sys.stdout
+        counts = {"submissions": 0, "failed": 0}
+        started = time.monotonic()
+        try:
+            # the pool processes are forked within these settings
+            with override_settings(
+                CELERY_DATADIR=work_dir,
+                VERIFICATION_ARCHIVE_CACHE_DIR=os.path.join(work_dir, "archive"),
+            ):
+                if options["archive"]:
+                    seed_snapshot(importer, cls, options["archive"])
+                tasks = (
+                    (importer,) + submission + (options["diff"],)
+                    for submission in find_submissions(options["root"])
+                )
+                connections.close_all()
+                with multiprocessing.get_context("fork").Pool(
+                    options["processes"],
+                    initializer=init_process,
+                    initargs=(importer,),
+                    maxtasksperchild=options["max_tasks_per_child"],
+                ) as pool:
+                    for result in pool.imap_unordered(check_submission, tasks):
+                        counts["submissions"] += 1
+                        if (
+                            result.get("error")
+                            or result.get("xlsx_errors")
+                            or result.get("md5_errors")
+                            or result.get("diff")
+                        ):
+                            counts["failed"] += 1
+                        out.write(json.dumps(result) + "\n")
+                        out.flush()
+        finally:
+            if out is not sys.stdout:
+                out.close()
+            shutil.rmtree(work_dir, ignore_errors=True)
+        self.stderr.write(
+            "%d submissions verified in %.1f seconds, %d with errors"
+            % (counts["submissions"], time.monotonic() - started, counts["failed"])
+        )
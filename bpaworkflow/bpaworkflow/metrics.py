@@ -0,0 +1,166 @@
+"""
+timing and resource use of each stage of the verification pipeline.
+
+each stage of a job records its wall time, CPU time, peak resident set size and
+the time it waited in the queue into the job state. the same measurements are
+aggregated into histograms by importer and stage, which are held in redis so
+that every worker contributes to them, and exposed in the Prometheus text
+format.
+"""
+
+import logging
+import os
+import resource
+import time
+from collections import defaultdict
+from contextlib import suppress
+
+import redis
+from django.conf import settings
+
+from .models import redis_client
+
+logger = logging.getLogger("rainbow")
+
+histograms_key = "bpaworkflow:metrics"
+
+seconds_buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+bytes_buckets = tuple((1 << 20) * n for n in (64, 128, 256, 512, 1024, 2048, 4096))
+
+# metric name, key of the stage measurements, buckets, help text
+HISTOGRAMS = (
+    (
+        "bpaworkflow_stage_wall_seconds",
+        "wall",
+        seconds_buckets,
+        "Wall time of a pipeline stage.",
+    ),
+    (
+        "bpaworkflow_stage_cpu_seconds",
+        "cpu",
+        seconds_buckets,
+        "CPU time of a pipeline stage.",
+    ),
+    (
+        "bpaworkflow_stage_queue_wait_seconds",
+        "queue_wait",
+        seconds_buckets,
+        "Time a pipeline stage waited in the queue before it started.",
+    ),
+    (
+        "bpaworkflow_stage_peak_rss_bytes",
+        "peak_rss",
+        bytes_buckets,
+        "Peak resident set size of the worker process during a pipeline stage.",
+    ),
+)
+
+
+def reset_peak_rss():
+    "reset the peak RSS of this process, where the kernel allows it"
+    with suppress(OSError):
+        with open("/proc/self/clear_refs", "w") as fd:
+            fd.write("5")
+
+
+def peak_rss():
+    "peak RSS of this process in bytes, since it was last reset"
+    with suppress(OSError, ValueError):
+        with open("/proc/self/status") as fd:
+            for line in fd:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    # without procfs, the peak over the life of the process
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageTimer:
+    """
+    measures a pipeline stage; `sent_at` is the time the stage's task was queued
+    """
+
+    def __init__(self, sent_at=None):
+        self.sent_at = sent_at
+
+    def __enter__(self):
+        reset_peak_rss()
+        self.started = time.time()
+        self.cpu_started = time.process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.measurements = {
+            "started": self.started,
+            "wall": time.time() - self.started,
+            "cpu": time.process_time() - self.cpu_started,
+            "peak_rss": peak_rss(),
+            "queue_wait": None,
+            "pid": os.getpid(),
+        }
+        if self.sent_at is not None:
+            self.measurements["queue_wait"] = max(0, self.started - self.sent_at)
+
+
+def field(metric, importer, stage, suffix):
+    return "|".join((metric, importer, stage, suffix))
+
+
+def observe(importer, stage, measurements):
+    "add the measurements of a stage to the histograms"
+    if not settings.VERIFICATION_STAGE_METRICS:
+        return
+    try:
+        with redis_client.pipeline(transaction=False) as pipe:
+            for metric, key, buckets, _ in HISTOGRAMS:
+                value = measurements.get(key)
+                if value is None:
+                    continue
+                for le in buckets:
+                    if value <= le:
+                        pipe.hincrby(
+                            histograms_key, field(metric, importer, stage, str(le)), 1
+                        )
+                pipe.hincrby(histograms_key, field(metric, importer, stage, "+Inf"), 1)
+                pipe.hincrbyfloat(
+                    histograms_key, field(metric, importer, stage, "sum"), value
+                )
+                pipe.hincrby(histograms_key, field(metric, importer, stage, "count"), 1)
+            pipe.execute()
+    except redis.RedisError as e:
+        logger.error("Unable to record metrics: %s" % (repr(e)))
+
+
+def label_value(s):
+    return s.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render():
+    "the histograms, in the Prometheus text exposition format"
+    series = defaultdict(dict)
+    for k, v in redis_client.hgetall(histograms_key).items():
+        metric, importer, stage, suffix = k.decode("utf8").split("|")
+        series[(metric, importer, stage)][suffix] = v.decode("utf8")
+
+    lines = []
+    for metric, _, buckets, help_text in HISTOGRAMS:
+        lines.append("# HELP {} {}".format(metric, help_text))
+        lines.append("# TYPE {} histogram".format(metric))
+        for (name, importer, stage), values in sorted(series.items()):
+            if name != metric:
+                continue
+            labels = 'importer="{}",stage="{}"'.format(
+                label_value(importer), label_value(stage)
+            )
+            for le in [str(t) for t in buckets] + ["+Inf"]:
+                lines.append(
+                    '{}_bucket{{{},le="{}"}} {}'.format(
+                        metric, labels, le, values.get(le, "0")
+                    )
+                )
+            lines.append(
+                "{}_sum{{{}}} {}".format(metric, labels, values.get("sum", "0"))
+            )
+            lines.append(
+                "{}_count{{{}}} {}".format(metric, labels, values.get("count", "0"))
+            )
+    return "\n".join(lines) + "\n"
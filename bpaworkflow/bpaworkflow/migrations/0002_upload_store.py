@@ -0,0 +1,23 @@
+# Generated by Django 3.0.6 on 2026-10-18 02:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bpaworkflow", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="verificationjob",
+            name="md5_sha256",
+            field=models.CharField(blank=True, default="", max_length=64),
+        ),
+        migrations.AddField(
+            model_name="verificationjob",
+            name="xlsx_sha256",
+            field=models.CharField(blank=True, default="", max_length=64),
+        ),
+    ]
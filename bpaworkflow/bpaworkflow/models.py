@@ -1,11 +1,27 @@
+from django.conf import settings
 from django.contrib.postgres.fields import JSONField
 from django.db import models
-from bpaingest.projects import ProjectInfo
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
 import uuid
+import json
 import logging
+import redis
+import time
+from contextlib import suppress
+
+from . import registry
 
 logger = logging.getLogger("rainbow")
-project_info = ProjectInfo()
+redis_client = redis.StrictRedis(host=settings.REDIS_HOST, db=settings.REDIS_DB)
+
+# the parts of the job state reported by the status API
+STATUS_KEYS = ("complete", "md5", "xlsx", "diff", "cancelled")
+
+
+class VerificationJobQuerySet(models.QuerySet):
+    def without_uploads(self):
+        return self.defer("xlsx_data", "md5_data")
 
 
 class VerificationJob(models.Model):
@@ -18,14 +34,20 @@ class VerificationJob(models.Model):
     submitted = models.DateTimeField(auto_now=True)
     importer = models.TextField()
     xlsx_name = models.TextField()
-    xlsx_data = models.BinaryField(null=True)
+    xlsx_sha256 = models.CharField(max_length=64, blank=True, default="")
     md5_name = models.TextField()
+    md5_sha256 = models.CharField(max_length=64, blank=True, default="")
+    # uploads are kept in the upload store, and referenced by digest; these
+    # hold the uploads of jobs submitted before the store was introduced
+    xlsx_data = models.BinaryField(null=True)
     md5_data = models.BinaryField(null=True)
     # state as we track through the verification pipeline is stored in here
     state = JSONField()
 
+    objects = VerificationJobQuerySet.as_manager()
+
     def get_importer_cls(self):
-        return project_info.cli_options()[self.importer]
+        return registry.importers()[self.importer]
 
     @classmethod
     def create(cls, **kwargs):
@@ -35,9 +57,139 @@ class VerificationJob(models.Model):
         return job
 
     def set(self, **kwargs):
-        for k, v in kwargs.items():
-            self.state[k] = v
-            self.save()
+        # merge just the given keys into the stored state, in a single statement:
+        # pipeline stages which run concurrently may each update the same job, and
+        # this avoids rewriting the uploaded files along with the state
+        VerificationJob.objects.filter(pk=self.pk).update(
+            state=RawSQL("state || %s::jsonb", (json.dumps(kwargs),)),
+            submitted=timezone.now(),
+        )
+        self.state.update(kwargs)
+        self.mirror_status(kwargs)
+
+    @classmethod
+    def mark_shared(cls, job_uuid):
+        """
+        note that the job has been given to an identical submission, so it is
+        never cancelled. this isn't progress on the job, so unlike `set` it
+        leaves `submitted` alone.
+        """
+        cls.objects.filter(uuid=job_uuid).update(
+            state=RawSQL("state || %s::jsonb", (json.dumps({"shared": True}),))
+        )
 
     def get(self, k):
         return self.state[k]
+
+    def is_cancelled(self):
+        "whether the job has been cancelled, including since its state was loaded"
+        return (
+            self.state.get("cancelled")
+            or VerificationJob.objects.filter(
+                pk=self.pk, state__cancelled=True
+            ).exists()
+        )
+
+    @staticmethod
+    def status_key(job_uuid):
+        return "bpaworkflow:status:{}".format(job_uuid)
+
+    @staticmethod
+    def status_channel(job_uuid):
+        return "bpaworkflow:status-updates:{}".format(job_uuid)
+
+    def mirror_status(self, state):
+        """
+        mirror the status keys of the job state into redis, so that the status
+        API can be served without querying the database. each change bumps the
+        status version, which is published to anyone waiting on the job.
+
+        returns the new version, or None if nothing was mirrored.
+        """
+        mirrored = dict(
+            (k, json.dumps(v)) for k, v in state.items() if k in STATUS_KEYS
+        )
+        if not mirrored:
+            return None
+        key = self.status_key(self.uuid)
+        try:
+            with redis_client.pipeline() as pipe:
+                pipe.hmset(key, mirrored)
+                pipe.hincrby(key, "version", 1)
+                pipe.expire(key, settings.VERIFICATION_STATUS_TTL)
+                _, version, _ = pipe.execute()
+            redis_client.publish(self.status_channel(self.uuid), version)
+            return version
+        except redis.RedisError as e:
+            # the database remains authoritative; drop the mirror rather than
+            # leave it stale
+            logger.error("Unable to mirror job status to redis: %s" % (repr(e)))
+            with suppress(redis.RedisError):
+                redis_client.delete(key)
+
+    def backfill_status(self, status):
+        """
+        mirror the job status read from the database, without overwriting any
+        of it already mirrored: a worker may have mirrored a later update since
+        the status was read. returns the mirrored status, or None if it can't
+        be mirrored.
+        """
+        key = self.status_key(self.uuid)
+        try:
+            with redis_client.pipeline() as pipe:
+                for k in STATUS_KEYS:
+                    pipe.hsetnx(key, k, json.dumps(status[k]))
+                pipe.hsetnx(key, "version", 1)
+                pipe.expire(key, settings.VERIFICATION_STATUS_TTL)
+                pipe.execute()
+            return self.mirrored_status(self.uuid)
+        except redis.RedisError as e:
+            logger.error("Unable to mirror job status to redis: %s" % (repr(e)))
+            return None
+
+    @classmethod
+    def mirrored_status(cls, job_uuid):
+        """
+        returns the job status from redis, or None if it isn't mirrored there
+        """
+        mirrored = redis_client.hgetall(cls.status_key(job_uuid))
+        if not mirrored:
+            return None
+        status = dict((k, None) for k in STATUS_KEYS + ("version",))
+        status.update((k.decode("utf8"), json.loads(v)) for k, v in mirrored.items())
+        return status
+
+    @classmethod
+    def get_status(cls, job_uuid):
+        try:
+            status = cls.mirrored_status(job_uuid)
+        except redis.RedisError:
+            status = None
+        if status is None:
+            job = cls.objects.without_uploads().get(uuid=job_uuid)
+            status = dict((k, job.state.get(k)) for k in STATUS_KEYS)
+            status["version"] = None
+            status = job.backfill_status(status) or status
+        return status
+
+    @classmethod
+    def wait_status(cls, job_uuid, version, timeout):
+        """
+        returns the job status as soon as its version is later than `version`,
+        or the job is complete, or `timeout` seconds have passed
+        """
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        try:
+            # subscribe before reading the status, so that no update is missed
+            pubsub.subscribe(cls.status_channel(job_uuid))
+            deadline = time.monotonic() + timeout
+            status = cls.get_status(job_uuid)
+            while (status["version"] or 0) <= version and not status["complete"]:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if pubsub.get_message(timeout=remaining) is not None:
+                    status = cls.get_status(job_uuid)
+            return status
+        finally:
+            pubsub.close()
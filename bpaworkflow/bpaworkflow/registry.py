@@ -0,0 +1,32 @@
+"""
+registry of the bpaingest importers, shared by the web and worker processes.
+
+importing `bpaingest.projects` imports every importer module, so it is put off
+until an importer is first needed, rather than slowing the start of every
+process which loads bpaworkflow. the registry and its index by slug are then
+kept for the lifetime of the process.
+"""
+
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def project_info():
+    from bpaingest.projects import ProjectInfo
+
+    return ProjectInfo()
+
+
+@lru_cache(maxsize=None)
+def importers():
+    "the importer classes, by slug"
+    return dict(project_info().cli_options())
+
+
+def get_importer(slug):
+    "returns the importer class for `slug`, or None"
+    return importers().get(slug)
+
+
+def metadata_info():
+    return project_info().metadata_info
@@ -0,0 +1,157 @@
+"""
+cache of verification results, keyed on the content of the submission.
+
+a submission identical to an earlier one (the same importer and uploaded files,
+checked by the same version of the software) is given the earlier job, rather
+than starting a new one: if that job is complete its results are available
+immediately, and if it is still running the submission follows its progress.
+
+the cache is held in redis, and bounded in both age and number of entries;
+the least recently used entries are evicted first. entries live no longer than
+the archive metadata cache, so that results aren't reused once the archive they
+were checked against may have changed. a job which is still in progress, but
+whose pipeline hasn't recorded progress recently, is presumed lost (the worker
+running it may have died) and isn't reused.
+"""
+
+import hashlib
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import redis
+from django.conf import settings
+
+from .archive import bpaingest_version
+from .models import VerificationJob, redis_client
+
+logger = logging.getLogger("rainbow")
+
+index_key = "bpaworkflow:results"
+
+
+def entry_key(key):
+    return "bpaworkflow:result:{}".format(key)
+
+
+def submission_key(importer, uploads):
+    """
+    `uploads` is a list of (name, sha256) tuples
+    """
+    h = hashlib.sha256()
+    h.update(
+        json.dumps([settings.VERSION, bpaingest_version(), importer, uploads]).encode(
+            "utf8"
+        )
+    )
+    return h.hexdigest()
+
+
+def cache_ttl():
+    return min(
+        settings.VERIFICATION_RESULT_CACHE_TTL, settings.VERIFICATION_ARCHIVE_CACHE_TTL
+    )
+
+
+def progress_key(job_uuid):
+    return "bpaworkflow:progress:{}".format(job_uuid)
+
+
+def record_progress(job_uuid):
+    """
+    note that the pipeline of the job is making progress; only the pipeline
+    records this, and the record lapses once the job is stale
+    """
+    try:
+        redis_client.set(
+            progress_key(job_uuid), 1, ex=settings.VERIFICATION_RESULT_CACHE_STALE
+        )
+    except redis.RedisError as e:
+        logger.error("Unable to record job progress: %s" % (repr(e)))
+
+
+@contextmanager
+def heartbeat(job_uuids):
+    """
+    records progress on each of the jobs until the block exits, so that a long
+    pipeline stage isn't presumed lost while it runs
+    """
+    stopped = threading.Event()
+
+    def beat():
+        while True:
+            for job_uuid in job_uuids:
+                record_progress(job_uuid)
+            if stopped.wait(settings.VERIFICATION_RESULT_CACHE_STALE / 3):
+                return
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def is_live(job_uuid, status):
+    """
+    whether the job can be shared: it is complete, or its pipeline has recorded
+    progress recently
+    """
+    if status.get("cancelled"):
+        return False
+    if status.get("complete"):
+        return True
+    return bool(redis_client.exists(progress_key(job_uuid)))
+
+
+def lookup(key):
+    """
+    returns the uuid of the job for an identical submission, or None
+    """
+    try:
+        job_uuid = redis_client.get(entry_key(key))
+        if job_uuid is None:
+            return None
+        job_uuid = job_uuid.decode("utf8")
+        if not is_live(job_uuid, VerificationJob.get_status(job_uuid)):
+            forget(key)
+            return None
+        redis_client.zadd(index_key, {key: time.time()})
+    except VerificationJob.DoesNotExist:
+        forget(key)
+        return None
+    except redis.RedisError as e:
+        logger.error("Unable to query result cache: %s" % (repr(e)))
+        return None
+    return job_uuid
+
+
+def register(key, job_uuid):
+    try:
+        with redis_client.pipeline() as pipe:
+            pipe.set(entry_key(key), job_uuid, ex=cache_ttl())
+            pipe.zadd(index_key, {key: time.time()})
+            # drop index entries whose cache entries have expired
+            pipe.zremrangebyscore(index_key, "-inf", time.time() - cache_ttl())
+            pipe.zcard(index_key)
+            size = pipe.execute()[-1]
+        excess = size - settings.VERIFICATION_RESULT_CACHE_SIZE
+        if excess > 0:
+            for evicted in redis_client.zrange(index_key, 0, excess - 1):
+                forget(evicted.decode("utf8"))
+    except redis.RedisError as e:
+        logger.error("Unable to update result cache: %s" % (repr(e)))
+
+
+def forget(key):
+    try:
+        with redis_client.pipeline() as pipe:
+            pipe.delete(entry_key(key))
+            pipe.zrem(index_key, key)
+            pipe.execute()
+    except redis.RedisError as e:
+        logger.error("Unable to update result cache: %s" % (repr(e)))
@@ -374,6 +374,18 @@ CELERY_RESULT_SERIALIZER = "json"
 CELERY_TIMEZONE = TIME_ZONE
 CELERY_DATADIR = "/data"
 
+# the quick checks are routed to the "fast" queue, and the bpaingest diff to the
+# "heavy" queue, so that diffs waiting to run don't hold up the quick checks of
+# other submissions. archive cache warm-up has the "warm" queue to itself, so that
+# it doesn't hold up diffs. each queue is served by its own workers: see
+# CELERY_QUEUES in docker-entrypoint.sh
+CELERY_TASK_DEFAULT_QUEUE = "fast"
+CELERY_TASK_ROUTES = {
+    "bpaworkflow.tasks.validate_bpaingest_json": {"queue": "heavy"},
+    "bpaworkflow.tasks.validate_batch_diff": {"queue": "heavy"},
+    "bpaworkflow.tasks.prime_archive_cache": {"queue": "warm"},
+}
+
 # End Celery
 
 # cache using redis
@@ -430,5 +442,95 @@ NONDENOISED_REQUEST_EMAIL = env.get(
     "nondenoised_request_email", "am-data-requests@bioplatforms.com"
 )
 
-# maximum uploaded file size for verification pipeline (bytes)
-VERIFICATION_MAX_SIZE = 8 * (1 << 20)
+# maximum uploaded file size for verification pipeline (bytes). the "wrapper"
+# spreadsheet reader loads the whole workbook into memory, so unless the streaming
+# reader is enabled spreadsheets are held to the smaller limit
+VERIFICATION_MAX_SIZE = env.get("verification_max_size", 256 * (1 << 20))
+VERIFICATION_MAX_XLSX_SIZE = env.get("verification_max_xlsx_size", 8 * (1 << 20))
+
+# files are uploaded in chunks of this size (bytes); an upload which is not
+# submitted for verification is discarded after this long (seconds)
+VERIFICATION_UPLOAD_CHUNK_SIZE = env.get("verification_upload_chunk_size", 1 << 20)
+VERIFICATION_UPLOAD_TTL = env.get("verification_upload_ttl", 24 * 60 * 60)
+
+# content-addressed store of uploaded files, shared by the web and worker processes
+VERIFICATION_UPLOAD_DIR = env.get(
+    "verification_upload_dir", os.path.join(CELERY_DATADIR, "uploads")
+)
+
+# "chord" runs the spreadsheet and MD5 checks concurrently, "chain" runs every
+# stage of the verification pipeline one after the other
+VERIFICATION_PIPELINE = env.get("verification_pipeline", "chord")
+
+# job status is mirrored into redis for the status API, for this many seconds
+VERIFICATION_STATUS_TTL = env.get("verification_status_ttl", 24 * 60 * 60)
+
+# maximum time (seconds) a request to the status wait API blocks for an update. each
+# waiting request holds a web server thread, so this is off (0) by default and the
+# browser polls the status API instead; only enable it where the web server has a
+# thread (or an async worker) to spare for every open results page
+VERIFICATION_STATUS_WAIT = env.get("verification_status_wait", 0)
+
+# identical submissions share the results of a single job: for how long those
+# results are reused (seconds), and how many submissions are remembered
+VERIFICATION_RESULT_CACHE_TTL = env.get("verification_result_cache_ttl", 60 * 60)
+VERIFICATION_RESULT_CACHE_SIZE = env.get("verification_result_cache_size", 1000)
+# a job still in progress is only shared if its pipeline has recorded progress
+# within this many seconds; otherwise it is presumed lost, and a new job started
+VERIFICATION_RESULT_CACHE_STALE = env.get("verification_result_cache_stale", 15 * 60)
+
+# archive metadata fetched for the bpaingest diff is cached on disk, and shared by
+# all jobs for an importer until it expires (seconds) or the cache is full (bytes)
+VERIFICATION_ARCHIVE_CACHE_DIR = env.get(
+    "verification_archive_cache_dir", os.path.join(CELERY_DATADIR, "archive")
+)
+VERIFICATION_ARCHIVE_CACHE_TTL = env.get("verification_archive_cache_ttl", 60 * 60)
+VERIFICATION_ARCHIVE_CACHE_MAX_SIZE = env.get(
+    "verification_archive_cache_max_size", 4 * (1 << 30)
+)
+
+# "full" regenerates packages and resources for the whole archive with the
+# submission added; "incremental" generates them only for the submission, and
+# checks their linkage against an index of the archive. either way, linkage QC
+# runs over the submission's packages and resources and those of the archive
+# which share their linkage, so the modes report the same problems.
+VERIFICATION_DIFF_MODE = env.get("verification_diff_mode", "full")
+
+# errors are published to the job status as they are found, at most this often
+# (seconds); each check lists at most this many errors
+VERIFICATION_PROGRESS_INTERVAL = env.get("verification_progress_interval", 2.0)
+VERIFICATION_MAX_ERRORS = env.get("verification_max_errors", 1000)
+
+# the measurements of each pipeline stage are added to the aggregate metrics served
+# by the metrics API; the benchmark turns this off, so its runs aren't counted
+VERIFICATION_STAGE_METRICS = env.get("verification_stage_metrics", True)
+
+# "wrapper" checks spreadsheets with bpaingest's ExcelWrapper, which loads the whole
+# workbook; "streaming" reads and checks them a row at a time. only the streaming
+# reader uses the compiled (and warmed) spreadsheet schemas: ExcelWrapper builds its
+# field definitions anew for each spreadsheet
+VERIFICATION_XLSX_READER = env.get("verification_xlsx_reader", "wrapper")
+
+# clients may cache the metadata API response for this long (seconds), after
+# which they revalidate it with its ETag
+VERIFICATION_METADATA_MAX_AGE = env.get("verification_metadata_max_age", 300)
+
+# as each worker process starts, load the importers which can be verified and
+# compile their schemas; and as each worker starts, queue a task per importer
+# which fetches its archive metadata, at most once in this many seconds
+VERIFICATION_WARM_IMPORTERS = env.get("verification_warm_importers", True)
+VERIFICATION_WARM_ARCHIVE = env.get("verification_warm_archive", True)
+VERIFICATION_WARM_ARCHIVE_INTERVAL = env.get(
+    "verification_warm_archive_interval", 30 * 60
+)
+# only the archives of importers with a submission within this many seconds are warmed
+VERIFICATION_WARM_ARCHIVE_RECENT = env.get(
+    "verification_warm_archive_recent", 24 * 60 * 60
+)
+
+# for load tests and benchmarks: rather than fetching the archive metadata, use
+# the copy in <this directory>/<importer slug>, or an empty stand-in if there is none
+VERIFICATION_ARCHIVE_SEED_DIR = env.get("verification_archive_seed_dir", "")
+
+# the most submissions (pairs of spreadsheet and MD5 file) in a batch
+VERIFICATION_BATCH_MAX_SUBMISSIONS = env.get("verification_batch_max_submissions", 100)
@@ -0,0 +1,525 @@
+"""
+streaming reader for XLSX spreadsheets, for the spreadsheet check.
+
+xlrd (through bpaingest's ExcelWrapper) holds every cell of a workbook in memory.
+this reads the rows of a sheet one at a time from the XML within the XLSX, so
+memory use depends on the width of the sheet and the number of distinct strings
+in it, rather than its length. cells are xlrd Cells, so rows can be checked
+against a bpaingest field specification as ExcelWrapper would.
+
+merged cells are not supported: ExcelWrapper gives every cell of a merged range
+the value of its first cell, whereas here the other cells are empty.
+
+the rows parsed by the spreadsheet check are saved in the job's workspace, and
+loaded by the bpaingest diff, rather than parsing the spreadsheet again.
+"""
+
+import datetime
+import inspect
+import logging
+import os
+import pickle
+import posixpath
+import zipfile
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import lru_cache
+from types import SimpleNamespace
+from xml.etree.ElementTree import iterparse
+
+import xlrd
+from xlrd.formatting import FDT, is_date_format_string, std_format_code_types
+from xlrd.sheet import Cell
+
+from bpaingest.abstract import BaseMetadata
+from bpaingest.libs.excel_wrapper import FieldDefinition, SkipColumn
+
+ns_main = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+ns_rel = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+ns_pkg_rel = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+empty_cell = Cell(xlrd.XL_CELL_EMPTY, "")
+
+# is_date_format_string wants a workbook, for its logging settings
+format_book = SimpleNamespace(verbosity=0, logfile=None)
+
+
+def element_text(elem):
+    "the text of a string item, leaving out phonetic runs"
+    if elem.tag == ns_main + "t":
+        return elem.text or ""
+    return "".join(
+        element_text(child) for child in elem if child.tag != ns_main + "rPh"
+    )
+
+
+def read_workbook(zf):
+    """
+    returns ([(sheet name, part name)], date mode) for the workbook
+    """
+    targets = {}
+    with zf.open("xl/_rels/workbook.xml.rels") as fd:
+        for _, elem in iterparse(fd):
+            if elem.tag == ns_pkg_rel + "Relationship":
+                target = elem.get("Target")
+                if target.startswith("/"):
+                    target = target[1:]
+                else:
+                    target = posixpath.normpath(posixpath.join("xl", target))
+                targets[elem.get("Id")] = target
+    sheets = []
+    datemode = 0
+    with zf.open("xl/workbook.xml") as fd:
+        for _, elem in iterparse(fd):
+            if elem.tag == ns_main + "sheet":
+                sheets.append((elem.get("name"), targets[elem.get(ns_rel + "id")]))
+            elif elem.tag == ns_main + "workbookPr":
+                if elem.get("date1904") in ("1", "true"):
+                    datemode = 1
+    return sheets, datemode
+
+
+def read_shared_strings(zf):
+    strings = []
+    try:
+        fd = zf.open("xl/sharedStrings.xml")
+    except KeyError:
+        return strings
+    with fd:
+        for _, elem in iterparse(fd):
+            if elem.tag == ns_main + "si":
+                strings.append(element_text(elem))
+                elem.clear()
+    return strings
+
+
+def read_date_styles(zf):
+    """
+    returns the set of the indexes of the cell styles which format dates
+    """
+    formats = {}
+    date_styles = set()
+    try:
+        fd = zf.open("xl/styles.xml")
+    except KeyError:
+        return date_styles
+    with fd:
+        in_cell_xfs = False
+        index = 0
+        for event, elem in iterparse(fd, events=("start", "end")):
+            if elem.tag == ns_main + "cellXfs":
+                in_cell_xfs = event == "start"
+            elif event == "end" and elem.tag == ns_main + "numFmt":
+                formats[int(elem.get("numFmtId"))] = elem.get("formatCode", "")
+            elif event == "end" and elem.tag == ns_main + "xf" and in_cell_xfs:
+                fmt_id = int(elem.get("numFmtId", 0))
+                if fmt_id in formats:
+                    is_date = is_date_format_string(format_book, formats[fmt_id])
+                else:
+                    is_date = std_format_code_types.get(fmt_id) == FDT
+                if is_date:
+                    date_styles.add(index)
+                index += 1
+    return date_styles
+
+
+def column_index(ref):
+    "the zero-based column of a cell reference, such as `AB12'"
+    index = 0
+    for c in ref:
+        if not c.isalpha():
+            break
+        index = index * 26 + ord(c.upper()) - ord("A") + 1
+    return index - 1
+
+
+def make_cell(elem, shared_strings, date_styles):
+    cell_type = elem.get("t", "n")
+    value = elem.findtext(ns_main + "v")
+    if cell_type == "inlineStr":
+        inline = elem.find(ns_main + "is")
+        if inline is None:
+            return empty_cell
+        return Cell(xlrd.XL_CELL_TEXT, element_text(inline))
+    if value is None:
+        return empty_cell
+    if cell_type == "s":
+        return Cell(xlrd.XL_CELL_TEXT, shared_strings[int(value)])
+    if cell_type in ("str", "e"):
+        return Cell(xlrd.XL_CELL_TEXT, value)
+    if cell_type == "b":
+        return Cell(xlrd.XL_CELL_BOOLEAN, int(value))
+    if int(elem.get("s", 0)) in date_styles:
+        return Cell(xlrd.XL_CELL_DATE, float(value))
+    return Cell(xlrd.XL_CELL_NUMBER, float(value))
+
+
+def sheet_rows(fd, shared_strings, date_styles):
+    """
+    yields each row of the sheet in `fd` as a list of cells. rows without
+    values are yielded as empty lists, except at the end of the sheet, where
+    they are dropped (as xlrd does).
+    """
+    next_row = 0
+    empty_rows = 0
+    sheet_data = None
+    row = []
+    for event, elem in iterparse(fd, events=("start", "end")):
+        if event == "start":
+            if elem.tag == ns_main + "sheetData":
+                sheet_data = elem
+            elif elem.tag == ns_main + "row":
+                row = []
+            continue
+        if elem.tag == ns_main + "c":
+            ref = elem.get("r")
+            if ref is not None:
+                row.extend([empty_cell] * (column_index(ref) - len(row)))
+            row.append(make_cell(elem, shared_strings, date_styles))
+        elif elem.tag == ns_main + "row":
+            index = int(elem.get("r", next_row + 1)) - 1
+            empty_rows += index - next_row
+            next_row = index + 1
+            # drop the parsed row, so the tree doesn't grow with the sheet
+            sheet_data.clear()
+            if all(t is empty_cell for t in row):
+                empty_rows += 1
+                continue
+            for _ in range(empty_rows):
+                yield []
+            empty_rows = 0
+            yield row
+
+
+@contextmanager
+def open_sheet(fpath, sheet_name=None):
+    """
+    yields (name, rows, datemode) for the named sheet of the XLSX workbook at
+    `fpath`, or its first sheet; `rows` is an iterator as for `sheet_rows`
+    """
+    with zipfile.ZipFile(fpath) as zf:
+        sheets, datemode = read_workbook(zf)
+        if sheet_name is None:
+            name, part = sheets[0]
+        else:
+            name, part = next((t for t in sheets if t[0] == sheet_name), (None, None))
+            if part is None:
+                raise xlrd.XLRDError("No sheet named <%r>" % sheet_name)
+        shared_strings = read_shared_strings(zf)
+        date_styles = read_date_styles(zf)
+        with zf.open(part) as fd:
+            yield name, sheet_rows(fd, shared_strings, date_styles), datemode
+
+
+def column_finder(column_name):
+    """
+    returns a function which finds the index of the column `column_name` in a
+    header, or -1, as ExcelWrapper does. `column_name` is a string, a regular
+    expression, or a tuple of alternatives.
+    """
+    if isinstance(column_name, tuple):
+        finders = [column_finder(t) for t in column_name]
+
+        def find_first(header):
+            return next((t for t in (f(header) for f in finders) if t != -1), -1)
+
+        return find_first
+
+    if hasattr(column_name, "match"):
+
+        def find_re(header):
+            return next(
+                (idx for idx, name in enumerate(header) if column_name.match(name)), -1
+            )
+
+        return find_re
+
+    name = column_name.strip().lower()
+
+    def find(header):
+        try:
+            return header.index(name)
+        except ValueError:
+            return -1
+
+    return find
+
+
+def takes_logger(coerce):
+    """
+    coerce functions in newer versions of bpaingest are passed a logger
+    """
+    try:
+        parameters = list(inspect.signature(coerce).parameters)
+    except (TypeError, ValueError):
+        return False
+    return bool(parameters) and parameters[0] == "logger"
+
+
+def bind_coerce(coerce):
+    "returns coerce(logger, value), whichever form `coerce` takes"
+    if coerce is None:
+        return None
+    if takes_logger(coerce):
+        return coerce
+    return lambda logger, val: coerce(val)
+
+
+# a field of a compiled schema; `find` is as returned by `column_finder`
+CompiledField = namedtuple(
+    "CompiledField", ["attribute", "description", "optional", "find", "coerce"]
+)
+CompiledSchema = namedtuple(
+    "CompiledSchema", ["fields", "skip", "skip_all", "options", "names"]
+)
+
+
+@lru_cache(maxsize=None)
+def compile_schema(cls):
+    """
+    the spreadsheet field specification of the importer `cls`, with its column
+    matchers and coerce functions prepared; compiled once per process. used by
+    the streaming reader only, as ExcelWrapper prepares its own.
+    """
+    fields = []
+    skip = []
+    skip_all = []
+    for spec in cls.spreadsheet["fields"]:
+        if isinstance(spec, SkipColumn):
+            if spec.skip_all:
+                skip_all.append(spec.column_name)
+            else:
+                skip.append(column_finder(spec.column_name))
+            continue
+        if not isinstance(spec, FieldDefinition):
+            continue
+        description = spec.column_name
+        if hasattr(spec.column_name, "match"):
+            description = spec.column_name.pattern
+        fields.append(
+            CompiledField(
+                spec.attribute,
+                description,
+                spec.optional,
+                column_finder(spec.column_name),
+                bind_coerce(spec.coerce),
+            )
+        )
+    return CompiledSchema(
+        fields,
+        skip,
+        skip_all,
+        cls.spreadsheet["options"],
+        [t.attribute for t in fields],
+    )
+
+
+def map_columns(schema, header, file_name, sheet_name, error):
+    """
+    returns the column in `header` of each field of `schema`, or None, as
+    ExcelWrapper maps them; problems with the header are passed to `error`
+    """
+    skip_columns = set(find(header) for find in schema.skip)
+    for column_re in schema.skip_all:
+        skip_columns.update(
+            idx for idx, name in enumerate(header) if column_re.match(name)
+        )
+
+    columns = []
+    for field in schema.fields:
+        col_index = field.find(header)
+        if col_index != -1:
+            columns.append(col_index)
+            continue
+        if not field.optional:
+            error(
+                "Column `{}' not found in `{}' `{}'".format(
+                    field.description, file_name, sheet_name
+                )
+            )
+        columns.append(None)
+
+    mapped_columns = set(columns)
+    for idx, s in enumerate(header):
+        if s != "" and idx not in mapped_columns and idx not in skip_columns:
+            error(
+                "Column `{}' not mapped to an output field in `{}` `{}`".format(
+                    s, file_name, sheet_name
+                )
+            )
+    return columns
+
+
+class RowLogger(logging.LoggerAdapter):
+    """
+    passed to the coerce function of each field; warnings and errors it logs
+    are reported as errors in the spreadsheet, with the row and column
+    """
+
+    def __init__(self, logger, error):
+        super().__init__(logger, {})
+        self.error_callback = error
+        self.location = None
+
+    def log(self, level, msg, *args, **kwargs):
+        if level >= logging.WARNING:
+            self.error_callback(
+                "Row {}, column `{}': {}".format(
+                    *self.location, str(msg) % args if args else msg
+                )
+            )
+        else:
+            super().log(level, msg, *args, **kwargs)
+
+
+def check_rows(logger, schema, fpath, max_errors=None, on_row=None):
+    """
+    returns the errors found in the spreadsheet at `fpath`, reading it a row at
+    a time and checking it against `schema`, as from `compile_schema`. stops
+    reading after `max_errors` errors. the values of each row, as coerced for
+    the fields of the schema, are passed to `on_row`.
+    """
+    errors = []
+
+    class TooManyErrors(Exception):
+        pass
+
+    def error(message):
+        errors.append(message)
+        if max_errors is not None and len(errors) >= max_errors:
+            raise TooManyErrors()
+
+    options = schema.options
+    header_length = options.get("header_length", 0)
+    column_name_row_index = options.get("column_name_row_index", 0)
+    file_name = os.path.basename(fpath)
+    row_logger = RowLogger(logger, error)
+
+    def coerce_header(cell):
+        if not isinstance(cell.value, str):
+            error(
+                "header is not a string: %s `%s'" % (type(cell.value), repr(cell.value))
+            )
+        return str(cell.value).strip().lower()
+
+    try:
+        with open_sheet(fpath, options.get("sheet_name")) as (
+            sheet_name,
+            rows,
+            datemode,
+        ):
+            columns = None
+            for row_idx, row in enumerate(rows):
+                if row_idx == column_name_row_index:
+                    header = [coerce_header(t) for t in row]
+                    columns = map_columns(schema, header, file_name, sheet_name, error)
+                if row_idx < header_length or columns is None:
+                    continue
+                values = []
+                for field, i in zip(schema.fields, columns):
+                    if i is None:
+                        values.append(None)
+                        continue
+                    cell = row[i] if i < len(row) else empty_cell
+                    row_logger.location = (row_idx + 1, field.description)
+                    val = cell.value
+                    if cell.ctype == xlrd.XL_CELL_DATE:
+                        try:
+                            tpl = xlrd.xldate_as_tuple(val, datemode)
+                            if tpl[:3] == (0, 0, 0):
+                                val = datetime.time(*tpl[3:])
+                            else:
+                                val = datetime.datetime(*tpl)
+                        except (ValueError, xlrd.xldate.XLDateError):
+                            error(
+                                "column: `%s' -- value `%s' cannot be converted "
+                                "to a date" % (i, val)
+                            )
+                    elif cell.ctype == xlrd.XL_CELL_TEXT:
+                        val = val.strip()
+                    if field.coerce is not None:
+                        try:
+                            val = field.coerce(row_logger, val)
+                        except Exception as e:
+                            row_logger.error(repr(e))
+                    values.append(val)
+                if on_row is not None:
+                    on_row(values)
+    except TooManyErrors:
+        errors.append(
+            "Only the first %d errors are listed; the spreadsheet was not read "
+            "any further." % max_errors
+        )
+    return errors
+
+
+@contextmanager
+def row_writer(path, names, batch_size=1000):
+    """
+    yields a function which saves a row, a sequence of values named by `names`,
+    to `path`. rows are written as they are given, in batches stored column by
+    column, which pickles more compactly than row objects.
+    """
+    batch = []
+
+    def flush():
+        pickle.dump(list(zip(*batch)), fd, protocol=pickle.HIGHEST_PROTOCOL)
+        batch.clear()
+
+    def write(row):
+        batch.append(row)
+        if len(batch) >= batch_size:
+            flush()
+
+    with open(path, "wb") as fd:
+        pickle.dump(list(names), fd, protocol=pickle.HIGHEST_PROTOCOL)
+        yield write
+        if batch:
+            flush()
+
+
+def save_rows(path, names, rows):
+    with row_writer(path, names) as write:
+        for row in rows:
+            write(row)
+
+
+def load_rows(path, typname="DataRow"):
+    "load rows saved by `row_writer` as namedtuples, as ExcelWrapper returns them"
+    rows = []
+    with open(path, "rb") as fd:
+        typ = namedtuple(typname, pickle.load(fd))
+        while True:
+            try:
+                columns = pickle.load(fd)
+            except EOFError:
+                break
+            rows.extend(typ(*t) for t in zip(*columns))
+    return rows
+
+
+def parsed_spreadsheet_class(cls, rows_paths):
+    """
+    a subclass of the importer `cls` which loads the rows of each spreadsheet
+    named in `rows_paths` from the path it maps to, rather than parsing it
+    again. importers which parse spreadsheets in their own way are returned
+    unchanged.
+    """
+    # looked up without binding, as `parse_spreadsheet` is a method of the
+    # importer instance (which holds the logger) in current bpaingest, and a
+    # classmethod in older versions
+    base_parse = inspect.getattr_static(BaseMetadata, "parse_spreadsheet")
+    if inspect.getattr_static(cls, "parse_spreadsheet") is not base_parse:
+        return cls
+
+    def parse_spreadsheet(self, path, metadata_info):
+        rows_path = rows_paths.get(os.path.basename(path))
+        if rows_path is not None:
+            return load_rows(rows_path)
+        return base_parse.__get__(self, type(self))(path, metadata_info)
+
+    return type(
+        cls.__name__,
+        (cls,),
+        {"__module__": cls.__module__, "parse_spreadsheet": parse_spreadsheet},
+    )
@@ -160,19 +160,103 @@ $(document).ready(function () {
         reset_ui();
     });
 
+    // upload a file in chunks; if a chunk fails, ask the server how much of
+    // the file it has, and resume from there
+    var upload_file = function (file) {
+        var upload_endpoint = window.bpa_workflow_config['upload_endpoint'];
+        var csrf_token = $("#verify-form input[name='csrfmiddlewaretoken']").val();
+        var uploaded = $.Deferred();
+        var retries = 0;
+
+        var send = function (upload_id, uploaded_bytes) {
+            $("#verify-form").fileupload('send', {
+                files: [file],
+                url: upload_endpoint,
+                paramName: 'file',
+                maxChunkSize: window.bpa_workflow_config['upload_chunk_size'],
+                uploadedBytes: uploaded_bytes,
+                formData: [
+                    {'name': 'upload_id', 'value': upload_id},
+                    {'name': 'csrfmiddlewaretoken', 'value': csrf_token}
+                ]
+            }).done(function () {
+                uploaded.resolve(upload_id);
+            }).fail(function (xhr, text_status) {
+                if (text_status === 'abort' || retries >= 5) {
+                    uploaded.reject();
+                    return;
+                }
+                retries += 1;
+                $.ajax({
+                    method: 'GET',
+                    dataType: 'json',
+                    url: upload_endpoint,
+                    data: {'upload_id': upload_id},
+                }).done(function (status) {
+                    if (status['sha256']) {
+                        uploaded.resolve(upload_id);
+                    } else {
+                        send(upload_id, status['received']);
+                    }
+                }).fail(function () {
+                    uploaded.reject();
+                });
+            });
+        };
+
+        $.ajax({
+            method: 'POST',
+            dataType: 'json',
+            url: upload_endpoint,
+            data: {
+                'name': file.name,
+                'size': file.size,
+                'csrfmiddlewaretoken': csrf_token
+            },
+        }).done(function (status) {
+            send(status['upload_id'], 0);
+        }).fail(function () {
+            uploaded.reject();
+        });
+        return uploaded.promise();
+    };
+
     window.poll_handler = null;
+    window.wait_request = null;
 
     $('#verify-btn').click(function (e) {
         e.preventDefault();
+        // stop following the status of any previous submission
+        if (window.wait_request) {
+            window.wait_request.abort();
+        }
+        if (window.poll_handler) {
+            clearTimeout(window.poll_handler);
+        }
         var target = $("#result");
         target.empty();
         target.append('<p>Validating, please wait...</p>');
-        $("#verify-form").fileupload('send', {
-            files: filesList,
-            paramName: paramNames,
-            dataType: 'json',
-            formData: $("#verify-form").serializeArray()
-        }).complete(function (result) {
+        var upload_ids = {};
+        var uploads = $.map(filesList, function (file, i) {
+            return upload_file(file).done(function (upload_id) {
+                upload_ids[paramNames[i]] = upload_id;
+            });
+        });
+        $.when.apply($, uploads).then(function () {
+            var form_data = $("#verify-form").serializeArray();
+            $.each(upload_ids, function (param_name, upload_id) {
+                form_data.push({'name': param_name + '_upload', 'value': upload_id});
+            });
+            return $.ajax({
+                method: 'POST',
+                dataType: 'json',
+                url: window.bpa_workflow_config['validate_endpoint'],
+                data: form_data
+            });
+        }).fail(function () {
+            target.empty();
+            target.append('<p>Unable to submit files for validation, please try again.</p>');
+        }).done(function (response, text_status, result) {
             if (result.status != 200) {
                 // TODO: display an error message
                 return;
@@ -226,6 +310,28 @@ $(document).ready(function () {
 
             var response_obj = result.responseJSON;
             var submission_id = response_obj['submission_id'];
+            var version = 0;
+            // wait on the server for each change in the job status, if that's
+            // enabled; if not, or it isn't available, poll
+            var wait_result = function () {
+                window.wait_request = $.ajax({
+                    method: 'POST',
+                    dataType: 'json',
+                    url: window.bpa_workflow_config['status_wait_endpoint'],
+                    data: {'submission_id': submission_id, 'version': version},
+                }).done(function (response_obj) {
+                    display_result(response_obj);
+                    version = response_obj['version'] || version;
+                    if (response_obj['complete'] === false) {
+                        wait_result();
+                    }
+                }).fail(function (xhr, text_status) {
+                    if (text_status === 'abort') {
+                        return;
+                    }
+                    window.poll_handler = setTimeout(poll_result, 1000);
+                });
+            }
             var poll_result = function () {
                 $.ajax({
                     method: 'POST',
@@ -246,10 +352,11 @@ $(document).ready(function () {
                     }
                 });
             }
-            if (window.poll_handler) {
-                clearTimeout(window.poll_handler);
+            if (window.bpa_workflow_config['status_wait_endpoint']) {
+                wait_result();
+            } else {
+                window.poll_handler = setTimeout(poll_result, 1000);
             }
-            window.poll_handler = setTimeout(poll_result, 1000);
         });
     });
 });
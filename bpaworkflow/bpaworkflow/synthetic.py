@@ -0,0 +1,229 @@
+"""
+synthetic submissions, for benchmarks and load tests.
+
+a submission is generated from a template submission for an importer: the
+data rows of the template spreadsheet are repeated until the spreadsheet has
+the requested number of rows, and the MD5 file lists the template's files once
+for each copy of the rows. integer cells (the sample, library and dataset IDs
+of most importers) are offset in each copy, as are those IDs where they appear
+in file names, so that every row and file in the submission is distinct. the
+IDs in each column are offset by the span of that column's IDs in the template,
+which keeps them short enough to match the importers' file name conventions
+for submissions of tens of thousands of rows.
+"""
+
+import os
+import random
+import re
+import zipfile
+from xml.sax.saxutils import escape
+
+import xlrd
+from xlrd.sheet import Cell
+
+from .spreadsheet import open_sheet
+
+
+def read_template(cls, xlsx_path, md5_path):
+    """
+    returns (sheet name, preamble rows, data rows, date mode, md5 filenames)
+    """
+    options = cls.spreadsheet.get("options", {})
+    header_length = options.get("header_length", 1)
+    with open_sheet(xlsx_path, options.get("sheet_name")) as (name, rows, datemode):
+        rows = list(rows)
+    with open(md5_path) as fd:
+        filenames = [t.split(None, 1)[1].strip() for t in fd if t.strip()]
+    return name, rows[:header_length], rows[header_length:], datemode, filenames
+
+
+def is_id(cell):
+    return cell.ctype == xlrd.XL_CELL_NUMBER and cell.value == int(cell.value)
+
+
+def id_strides(rows):
+    """
+    returns {column index: stride} for the columns of `rows` holding IDs; each
+    copy of the rows offsets the IDs in a column by its stride
+    """
+    columns = {}
+    for row in rows:
+        for idx, t in enumerate(row):
+            if is_id(t):
+                columns.setdefault(idx, set()).add(int(t.value))
+    return dict((idx, max(ids) - min(ids) + 1) for idx, ids in columns.items())
+
+
+def column_letters(index):
+    letters = ""
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(ord("A") + rem) + letters
+    return letters
+
+
+def cell_xml(ref, cell, strings):
+    if cell.ctype == xlrd.XL_CELL_TEXT:
+        index = strings.setdefault(cell.value, len(strings))
+        return '<c r="{}" t="s"><v>{}</v></c>'.format(ref, index)
+    if cell.ctype == xlrd.XL_CELL_NUMBER:
+        return '<c r="{}"><v>{!r}</v></c>'.format(ref, cell.value)
+    if cell.ctype == xlrd.XL_CELL_DATE:
+        return '<c r="{}" s="1"><v>{!r}</v></c>'.format(ref, cell.value)
+    if cell.ctype == xlrd.XL_CELL_BOOLEAN:
+        return '<c r="{}" t="b"><v>{}</v></c>'.format(ref, int(cell.value))
+    return ""
+
+
+ns_main = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+ns_rel = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+ns_pkg_rel = "http://schemas.openxmlformats.org/package/2006/relationships"
+ct_base = "application/vnd.openxmlformats-officedocument.spreadsheetml"
+
+package_parts = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" '
+        'ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="{0}.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="{0}.worksheet+xml"/>'
+        '<Override PartName="/xl/styles.xml" ContentType="{0}.styles+xml"/>'
+        '<Override PartName="/xl/sharedStrings.xml" '
+        'ContentType="{0}.sharedStrings+xml"/>'
+        "</Types>"
+    ).format(ct_base),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="{0}">'
+        '<Relationship Id="rId1" Type="{1}/officeDocument" Target="xl/workbook.xml"/>'
+        "</Relationships>"
+    ).format(ns_pkg_rel, ns_rel),
+    "xl/_rels/workbook.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="{0}">'
+        '<Relationship Id="rId1" Type="{1}/worksheet" Target="worksheets/sheet1.xml"/>'
+        '<Relationship Id="rId2" Type="{1}/styles" Target="styles.xml"/>'
+        '<Relationship Id="rId3" Type="{1}/sharedStrings" Target="sharedStrings.xml"/>'
+        "</Relationships>"
+    ).format(ns_pkg_rel, ns_rel),
+    # the second cell style formats dates
+    "xl/styles.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<styleSheet xmlns="{0}">'
+        '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+        '<fills count="1"><fill><patternFill patternType="none"/></fill></fills>'
+        '<borders count="1"><border/></borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/>'
+        "</cellStyleXfs>"
+        '<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/>'
+        '<xf numFmtId="14" fontId="0" fillId="0" borderId="0" applyNumberFormat="1"/>'
+        "</cellXfs>"
+        "</styleSheet>"
+    ).format(ns_main),
+}
+
+
+def write_xlsx(fpath, sheet_name, rows, datemode):
+    """
+    write `rows`, an iterable of lists of xlrd Cells, to a single sheet XLSX
+    workbook at `fpath`
+    """
+    strings = {}
+    with zipfile.ZipFile(fpath, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, content in package_parts.items():
+            zf.writestr(name, content)
+        zf.writestr(
+            "xl/workbook.xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="{}" xmlns:r="{}"><workbookPr date1904="{}"/>'
+            '<sheets><sheet name="{}" sheetId="1" r:id="rId1"/></sheets>'
+            "</workbook>".format(
+                ns_main, ns_rel, int(datemode), escape(sheet_name, {'"': "&quot;"})
+            ),
+        )
+        with zf.open("xl/worksheets/sheet1.xml", "w") as fd:
+            fd.write(
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<worksheet xmlns="{}"><sheetData>'.format(ns_main).encode("utf8")
+            )
+            for row_index, row in enumerate(rows, 1):
+                cells = "".join(
+                    cell_xml("{}{}".format(column_letters(idx), row_index), t, strings)
+                    for idx, t in enumerate(row)
+                )
+                fd.write('<row r="{}">{}</row>'.format(row_index, cells).encode("utf8"))
+            fd.write(b"</sheetData></worksheet>")
+        zf.writestr(
+            "xl/sharedStrings.xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<sst xmlns="{}" count="{}" uniqueCount="{}">{}</sst>'.format(
+                ns_main,
+                len(strings),
+                len(strings),
+                "".join(
+                    '<si><t xml:space="preserve">{}</t></si>'.format(escape(t))
+                    for t in sorted(strings, key=strings.get)
+                ),
+            ),
+        )
+
+
+def synthetic_submission(cls, xlsx_template, md5_template, rows, target, seed=0):
+    """
+    write a submission of (at least) `rows` spreadsheet rows to the directory
+    `target`, generated from the template submission. the files are named as
+    the templates are. returns (xlsx path, md5 path).
+    """
+    sheet_name, preamble, data, datemode, filenames = read_template(
+        cls, xlsx_template, md5_template
+    )
+    if not data:
+        raise ValueError("the template spreadsheet has no data rows")
+    strides = id_strides(data)
+    # IDs in file names are offset as they are in the first column holding them
+    id_stride = {}
+    for row in data:
+        for idx, t in enumerate(row):
+            if idx in strides and is_id(t):
+                id_stride.setdefault(str(int(t.value)), strides[idx])
+    id_re = re.compile(
+        r"(?<!\d)({})(?!\d)".format("|".join(id_stride)) if id_stride else r"(?!)"
+    )
+    copies = -(-rows // len(data))
+
+    def copy_row(row, copy):
+        return [
+            Cell(t.ctype, t.value + copy * strides[idx])
+            if idx in strides and is_id(t)
+            else t
+            for idx, t in enumerate(row)
+        ]
+
+    def copy_filename(filename, copy):
+        return id_re.sub(
+            lambda m: str(int(m.group(1)) + copy * id_stride[m.group(1)]), filename
+        )
+
+    def all_rows():
+        yield from preamble
+        for copy in range(copies):
+            for row in data:
+                yield copy_row(row, copy)
+
+    xlsx_path = os.path.join(target, os.path.basename(xlsx_template))
+    md5_path = os.path.join(target, os.path.basename(md5_template))
+    write_xlsx(xlsx_path, sheet_name, all_rows(), datemode)
+    rng = random.Random(seed)
+    with open(md5_path, "w") as fd:
+        for copy in range(copies):
+            for filename in filenames:
+                fd.write(
+                    "{:032x}  {}\n".format(
+                        rng.getrandbits(128), copy_filename(filename, copy)
+                    )
+                )
+    return xlsx_path, md5_path
@@ -1,27 +1,43 @@
-from celery import shared_task
+from celery import shared_task, chord, group
 import os
 import re
 import tempfile
 import logging
 import shutil
-import redis
 import json
+import time
+import uuid
+import redis
 from django.http import HttpResponseForbidden
 from .validate import (
     verify_md5file,
     verify_spreadsheet,
+    verify_spreadsheet_streaming,
     collect_linkage_dump_linkage,
     exceptions_to_error,
 )
-from .models import VerificationJob
+from .models import VerificationJob, redis_client
+from . import batches, metrics, registry, resultcache, uploads
+from .spreadsheet import parsed_spreadsheet_class
+from .archive import (
+    archive_snapshot,
+    copy_snapshot,
+    linkage_index,
+    linkage_subset,
+    memoized_prior_state,
+    submission_changes,
+)
 from django.conf import settings
 from collections import defaultdict
 from bpaingest.metadata import DownloadMetadata
 from functools import wraps
 
-redis_client = redis.StrictRedis(host=settings.REDIS_HOST, db=settings.REDIS_DB)
-
 default_wait_message = "Validating, please wait..."
+cancelled_message = "(Cancelled: superseded by a later submission.)"
+unverified_message = "(No import result is available until md5 and xlsx files are successfully verified.)"
+diff_error_message = (
+    "E4001: There was a problem capturing packages and resources for metadata"
+)
 
 
 def make_file_logger(name):
@@ -38,6 +54,40 @@ def make_file_logger(name):
     return tmpf, logger
 
 
+def get_log_file(logfile):
+    with open(logfile) as fd:
+        log = fd.read()
+
+    os.unlink(logfile)
+
+    return log
+
+
+def generate_state(name, meta_maker):
+    """
+    returns the log, packages and resources (by data type), and importer
+    instances (by data type) of the metadata from `meta_maker`
+    """
+    logfile, logger = make_file_logger(name)
+    state = defaultdict(lambda: defaultdict(list))
+    data_type_meta = {}
+    # download metadata for all project types and aggregate metadata keys
+    with meta_maker(logger) as dlmeta:
+        meta = dlmeta.meta
+        data_type = meta.ckan_data_type
+        data_type_meta[data_type] = meta
+
+        state[data_type]["packages"] += meta.get_packages()
+        state[data_type]["resources"] += meta.get_resources()
+
+        for data_type in state:
+            state[data_type]["packages"].sort(key=lambda x: x["id"])
+            state[data_type]["resources"].sort(key=lambda x: x[2]["id"])
+
+    log = get_log_file(logfile)
+    return log, state, data_type_meta
+
+
 def wrapped_error_with_msg(func, msg):
     def inner_func(*args, **kwargs):
         try:
@@ -48,7 +98,64 @@ def wrapped_error_with_msg(func, msg):
     return inner_func
 
 
+def record_stage(job_uuids, stage, measurements):
+    logger = logging.getLogger("rainbow")
+    try:
+        jobs = [
+            VerificationJob.objects.without_uploads().get(uuid=job_uuid)
+            for job_uuid in job_uuids
+        ]
+        for job in jobs:
+            job.set(**{"metrics_{}".format(stage): measurements})
+        # the stage ran once, however many jobs it ran for
+        metrics.observe(jobs[0].importer, stage, measurements)
+    except Exception as e:
+        logger.error(
+            "Unable to record metrics for %s: %s" % (", ".join(job_uuids), repr(e))
+        )
+
+
+def instrumented(stage):
+    """
+    records the wall time, CPU time, peak RSS and queue wait of a pipeline stage
+    in the state of each job it runs for (under `metrics_<stage>`, as stages may
+    run concurrently), and adds them to the aggregate metrics. progress is
+    recorded on the jobs while the stage runs; see `resultcache.is_live`.
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, job_uuid, *args, **kwargs):
+            # stamped on the message as it was queued, in bpaworkflow.celery
+            sent_at = getattr(self.request, "sent_at", None)
+            timer = metrics.StageTimer(sent_at)
+            job_uuids = stage_job_uuids(job_uuid)
+            try:
+                with timer, resultcache.heartbeat(job_uuids):
+                    return func(self, job_uuid, *args, **kwargs)
+            finally:
+                record_stage(job_uuids, stage, timer.measurements)
+
+        return wrapper
+
+    return decorator
+
+
+def fabricate_metadata_info(cls, path):
+    # fabricate metadata information for the files uploaded by the user
+    metadata_info = {}
+    for filename in os.listdir(path):
+        # synthesise harmless additional context data so we can run the ingestor
+        metadata_info[os.path.basename(filename)] = obj = {
+            "base_url": "https://example.com/does-not-exist/",
+        }
+        for k in cls.metadata_url_components:
+            obj[k] = "BPAOPS-99999"
+    return metadata_info
+
+
 @shared_task(bind=True)
+@instrumented("setup")
 def validation_setup(self, job_uuid):
     logger = logging.getLogger("rainbow")
     logger.info("Beginning validation setup...")
@@ -56,194 +163,445 @@ def validation_setup(self, job_uuid):
     sets up the temporary working directory for the uploaded files
     """
 
-    def fabricate_metadata_info(path):
-        # fabricate metadata information for the files uploaded by the user
-        metadata_info = {}
-        for filename in os.listdir(path):
-            # synthesise harmless additional context data so we can run the ingestor
-            metadata_info[os.path.basename(filename)] = obj = {
-                "base_url": "https://example.com/does-not-exist/",
-            }
-            for k in cls.metadata_url_components:
-                obj[k] = "BPAOPS-99999"
-        return metadata_info
-
-    def write_file(fname, binary_field):
+    def link_file(fname, digest, data_field):
         target = os.path.join(temp_path, fname)
-        with open(target, "wb") as fd:
-            fd.write(binary_field)
+        if digest:
+            # the upload is read in place from the store
+            os.symlink(uploads.store_path(digest), target)
+        else:
+            # jobs submitted before uploads were kept in the store
+            with open(target, "wb") as fd:
+                fd.write(getattr(job, data_field))
         return target
 
-    def write_files():
+    def link_files():
         paths = {}
-        paths["xlsx"] = write_file(job.xlsx_name, job.xlsx_data)
-        paths["md5"] = write_file(job.md5_name, job.md5_data)
+        paths["xlsx"] = link_file(job.xlsx_name, job.xlsx_sha256, "xlsx_data")
+        paths["md5"] = link_file(job.md5_name, job.md5_sha256, "md5_data")
         return paths
 
-    job = VerificationJob.objects.get(uuid=job_uuid)
+    job = VerificationJob.objects.without_uploads().get(uuid=job_uuid)
     cls = job.get_importer_cls()
     temp_path = tempfile.mkdtemp(prefix="bpaworkflow-", dir=settings.CELERY_DATADIR)
-    path_info = write_files()
+    path_info = link_files()
     job.set(
         path_info=path_info,
         temp_path=temp_path,
-        temp_metadata_info=fabricate_metadata_info(temp_path),
+        temp_metadata_info=fabricate_metadata_info(cls, temp_path),
     )
     logger.info("Complete validation setup.")
     return job_uuid
 
 
-@shared_task(bind=True)
-def validate_spreadsheet(self, job_uuid):
-    job = VerificationJob.objects.get(uuid=job_uuid)
-    job.set(xlsx=[default_wait_message])
-    cls = job.get_importer_cls()
+def spreadsheet_rows_path(job):
+    return os.path.join(job.state["temp_path"], "spreadsheet-rows.pickle")
+
+
+def spreadsheet_errors(job, cls):
+    "check the job's spreadsheet, returning the errors found"
     logger = logging.getLogger("spreadsheet")
     paths = job.state["path_info"]
-    job.set(
-        xlsx=verify_spreadsheet(
-            logger, cls, paths["xlsx"], job.state["temp_metadata_info"]
+    # the parsed rows are kept for the bpaingest diff
+    rows_path = spreadsheet_rows_path(job)
+    if settings.VERIFICATION_XLSX_READER == "streaming":
+        return verify_spreadsheet_streaming(
+            logger,
+            cls,
+            paths["xlsx"],
+            job.state["temp_metadata_info"],
+            max_errors=settings.VERIFICATION_MAX_ERRORS,
+            rows_path=rows_path,
         )
+    return verify_spreadsheet(
+        logger,
+        cls,
+        paths["xlsx"],
+        job.state["temp_metadata_info"],
+        rows_path=rows_path,
     )
+
+
+@shared_task(bind=True)
+@instrumented("spreadsheet")
+def validate_spreadsheet(self, job_uuid):
+    job = VerificationJob.objects.without_uploads().get(uuid=job_uuid)
+    if job.is_cancelled():
+        job.set(xlsx=[cancelled_message])
+        return job_uuid
+    job.set(xlsx=[default_wait_message])
+    job.set(xlsx=spreadsheet_errors(job, job.get_importer_cls()))
     return job_uuid
 
 
 @shared_task(bind=True)
+@instrumented("md5")
 def validate_md5(self, job_uuid):
     logger = logging.getLogger("rainbow")
-    job = VerificationJob.objects.get(uuid=job_uuid)
+    job = VerificationJob.objects.without_uploads().get(uuid=job_uuid)
+    if job.is_cancelled():
+        job.set(md5=[cancelled_message])
+        return job_uuid
     job.set(md5=[default_wait_message])
     logger.info("md5 is set with default message.")
     cls = job.get_importer_cls()
     logger = logging.getLogger("md5")
     paths = job.state["path_info"]
-    result = verify_md5file(logger, cls, paths["md5"])
+
+    def report(errors):
+        job.set(md5=errors + [default_wait_message])
+
+    result = verify_md5file(
+        logger,
+        cls,
+        paths["md5"],
+        report=report,
+        max_errors=settings.VERIFICATION_MAX_ERRORS,
+        interval=settings.VERIFICATION_PROGRESS_INTERVAL,
+    )
     job.set(md5=result)
     return job_uuid
 
 
-@shared_task(bind=True)
-def validate_bpaingest_json(self, job_uuid):
-    logger = logging.getLogger("validate_bpaingest")
-    job = VerificationJob.objects.get(uuid=job_uuid)
+def stage_job_uuids(results):
+    """
+    the jobs a pipeline stage runs for: a stage is passed the uuid of its job;
+    a chord body the results of the chord header, which for a job are its uuid
+    from each task, and for a batch the uuid of each job of the batch
+    """
+    if isinstance(results, (list, tuple)):
+        return list(dict.fromkeys(results))
+    return [results]
 
-    # This job runs longer than others. Set a result early for subscriptions to capture as other results come in, before this one completed.
-    job.set(diff=[default_wait_message])
 
-    # retrieved from Redis, so just do it once
-    cls = job.get_importer_cls()
-    temp_metadata_info = job.state["temp_metadata_info"]
-    paths = job.state["path_info"]
+def header_job_uuid(results):
+    """
+    a chord body is passed the results of every task in the chord header,
+    each of which is the uuid of the same job
+    """
+    if isinstance(results, (list, tuple)):
+        return results[0]
+    return results
 
-    # Don't validate unless the list of errors returned for each previous job is empty
-    previous_errors = next(
-        (next_job for next_job in ["xlsx", "md5"] if job.get(next_job)), None
-    )
 
-    if previous_errors:
-        job.set(
-            diff=[
-                "(No import result is available until md5 and xlsx files are successfully verified.)"
-            ]
-        )
-        return job_uuid
+def archive_diff(logger, importer, cls, jobs, work_path, name, cancelled=None):
+    """
+    linkage QC of the packages and resources generated from the archive with
+    the submissions of `jobs` (all for `importer`) added to it. `work_path`
+    is a scratch directory, and `name` distinguishes the bpaingest logs.
+    returns the QC results of each job, in the order of `jobs`; or None if
+    `cancelled()` is true once the archive is ready.
+    """
+    # the spreadsheets were parsed when they were checked; load the rows rather
+    # than parsing them again
+    rows_paths = dict(
+        (os.path.basename(job.state["path_info"]["xlsx"]), spreadsheet_rows_path(job))
+        for job in jobs
+        if os.path.exists(spreadsheet_rows_path(job))
+    )
+    submission_cls = parsed_spreadsheet_class(cls, rows_paths) if rows_paths else cls
 
     def prior_metadata(logger):
-        return DownloadMetadata(logger, cls)
+        return DownloadMetadata(logger, cls, path=snapshot_path)
 
     def post_metadata(logger):
-        # this will go ahead and download the existing metadata
-        dlmeta = DownloadMetadata(logger, cls)
+        # work on a private copy of the existing metadata, which is removed on exit
+        dlmeta = DownloadMetadata(
+            logger,
+            submission_cls,
+            path=copy_snapshot(snapshot_path, os.path.join(work_path, "archive")),
+        )
+        dlmeta.cleanup = True
+        return add_submission(logger, dlmeta, jobs)
+
+    def submission_metadata(logger, submission_jobs, path):
+        # the contextual metadata and metadata info from the archive, without
+        # any of the archived submissions
+        os.mkdir(path)
+        for name in os.listdir(snapshot_path):
+            source = os.path.join(snapshot_path, name)
+            if os.path.isdir(source):
+                os.symlink(source, os.path.join(path, name))
+            elif name.endswith(".json"):
+                shutil.copy(source, os.path.join(path, name))
+        dlmeta = DownloadMetadata(logger, submission_cls, path=path)
+        dlmeta.cleanup = True
+        return add_submission(logger, dlmeta, submission_jobs)
+
+    def add_submission(logger, dlmeta, submission_jobs):
         # copy in the new metadata
-        for fpath in paths.values():
-            shutil.copy(fpath, os.path.join(dlmeta.path, os.path.basename(fpath)))
+        for job in submission_jobs:
+            for fpath in job.state["path_info"].values():
+                shutil.copy(fpath, os.path.join(dlmeta.path, os.path.basename(fpath)))
         # splice together the metadata from the archive with the synthetic metadata
         with open(dlmeta.info_json) as fd:
             metadata_info = json.load(fd)
-        metadata_info.update(temp_metadata_info)
+        for job in submission_jobs:
+            metadata_info.update(job.state["temp_metadata_info"])
         with open(dlmeta.info_json, "w") as fd:
             json.dump(metadata_info, fd)
         # recreate the class instance with the updated metadata
         dlmeta.meta = dlmeta.make_meta(logger)
         return dlmeta
 
-    def get_log_file(logfile):
-        with open(logfile) as fd:
-            log = fd.read()
-
-        os.unlink(logfile)
+    # the archive metadata is downloaded once, and shared by every job
+    with archive_snapshot(logger, importer, cls) as snapshot_path:
+        prior_index = memoized_prior_state(
+            snapshot_path,
+            lambda: generate_state("prior.{}".format(name), prior_metadata)[1],
+            cls.resource_linkage,
+        )[1]
+        if cancelled is not None and cancelled():
+            return None
+        if settings.VERIFICATION_DIFF_MODE == "incremental":
+            # only generate packages and resources for the submissions, and
+            # find what they link to in the archive via the index
+            post_log, post_state, post_data_type_meta = generate_state(
+                "submission.{}".format(name),
+                lambda logger: submission_metadata(
+                    logger, jobs, os.path.join(work_path, "submission")
+                ),
+            )
+            diff_state = linkage_subset(
+                prior_index,
+                submission_changes(prior_index, post_state, cls.resource_linkage),
+                cls.resource_linkage,
+            )
+        else:
+            post_log, post_state, post_data_type_meta = generate_state(
+                "post.{}".format(name), post_metadata
+            )
+            # the same subset, drawn from the archive as the submissions leave it
+            diff_state = linkage_subset(
+                linkage_index(post_state, cls.resource_linkage),
+                submission_changes(prior_index, post_state, cls.resource_linkage),
+                cls.resource_linkage,
+            )
+        if len(jobs) == 1 or not diff_state:
+            # there is nothing to split between the jobs
+            return [
+                collect_linkage_dump_linkage(logger, diff_state, post_data_type_meta)
+                for job in jobs
+            ]
+        # the packages and resources of each submission on its own, so each job
+        # is only given the problems involving its submission
+        job_states = [
+            generate_state(
+                "submission.{}.{}".format(name, job.uuid),
+                lambda logger, job=job: submission_metadata(
+                    logger, [job], os.path.join(work_path, "submission.%s" % job.uuid)
+                ),
+            )[1]
+            for job in jobs
+        ]
+    # QC over the part of the batch's state sharing linkage with a submission
+    # finds the problems of the batch which involve that submission
+    diff_index = linkage_index(diff_state, cls.resource_linkage)
+    return [
+        collect_linkage_dump_linkage(
+            logger,
+            linkage_subset(
+                diff_index,
+                submission_changes(prior_index, job_state, cls.resource_linkage),
+                cls.resource_linkage,
+            ),
+            post_data_type_meta,
+        )
+        for job_state in job_states
+    ]
 
-        return log
 
-    def run(name, meta_maker):
-        logfile, logger = make_file_logger(name)
-        state = defaultdict(lambda: defaultdict(list))
-        data_type_meta = {}
-        # download metadata for all project types and aggregate metadata keys
-        with meta_maker(logger) as dlmeta:
-            meta = dlmeta.meta
-            data_type = meta.ckan_data_type
-            data_type_meta[data_type] = meta
+@shared_task(bind=True)
+@instrumented("diff")
+def validate_bpaingest_json(self, job_uuid):
+    logger = logging.getLogger("validate_bpaingest")
+    job_uuid = header_job_uuid(job_uuid)
+    job = VerificationJob.objects.without_uploads().get(uuid=job_uuid)
+    if job.is_cancelled():
+        job.set(diff=[cancelled_message])
+        return job_uuid
 
-            state[data_type]["packages"] += meta.get_packages()
-            state[data_type]["resources"] += meta.get_resources()
+    # This job runs longer than others. Set a result early for subscriptions to capture as other results come in, before this one completed.
+    job.set(diff=[default_wait_message])
 
-            for data_type in state:
-                state[data_type]["packages"].sort(key=lambda x: x["id"])
-                state[data_type]["resources"].sort(key=lambda x: x[2]["id"])
+    # retrieved from Redis, so just do it once
+    cls = job.get_importer_cls()
+    temp_path = job.state["temp_path"]
 
-        log = get_log_file(logfile)
-        return log, state, data_type_meta
+    # Don't validate unless the list of errors returned for each previous job is empty
+    previous_errors = next(
+        (next_job for next_job in ["xlsx", "md5"] if job.get(next_job)), None
+    )
 
-    def diff_json(json1, json2):
-        difference = {k: json2[k] for k in set(json2) - set(json1)}
-        return difference
+    if previous_errors:
+        job.set(diff=[unverified_message])
+        return job_uuid
 
     try:
-        prior_log, prior_state, _prior_data_type_meta = run(
-            "prior.{}".format(job_uuid), prior_metadata
+        linkage_results = archive_diff(
+            logger, job.importer, cls, [job], temp_path, job_uuid, job.is_cancelled
         )
-        post_log, post_state, post_data_type_meta = run(
-            "post.{}".format(job_uuid), post_metadata
-        )
-        diff_state = diff_json(prior_state, post_state)
-        linkage_results = collect_linkage_dump_linkage(
-            logger, diff_state, post_data_type_meta
-        )
-        job.set(diff=linkage_results)
-    except Exception as p_and_r_error:
-        logger.error(
-            "There was a problem capturing packages or resources.", p_and_r_error,
+        # the job may have been superseded while waiting on the archive
+        if linkage_results is None:
+            job.set(diff=[cancelled_message])
+            return job_uuid
+        job.set(diff=linkage_results[0])
+    except Exception:
+        logger.exception("There was a problem capturing packages or resources.")
+        job.set(diff=[diff_error_message])
+        # the problem may be transient, so don't hand this result out again
+        if "result_key" in job.state:
+            resultcache.forget(job.state["result_key"])
+    return job_uuid
+
+
+@shared_task(bind=True)
+@instrumented("batch_diff")
+def validate_batch_diff(self, job_uuids, batch_id):
+    """
+    the bpaingest diff for a batch: the archive is checked once, with every
+    verified spreadsheet of the batch added to it, and each of those jobs is
+    given the results involving its own submission
+    """
+    logger = logging.getLogger("validate_bpaingest")
+    jobs = [VerificationJob.objects.without_uploads().get(uuid=t) for t in job_uuids]
+    verified = []
+    for job in jobs:
+        if job.state.get("xlsx") or job.state.get("md5"):
+            job.set(diff=[unverified_message])
+        else:
+            job.set(diff=[default_wait_message])
+            verified.append(job)
+    if not verified:
+        return job_uuids
+
+    work_path = tempfile.mkdtemp(
+        prefix="bpaworkflow-batch-", dir=settings.CELERY_DATADIR
+    )
+    try:
+        linkage_results = archive_diff(
+            logger,
+            verified[0].importer,
+            verified[0].get_importer_cls(),
+            verified,
+            work_path,
+            batch_id,
         )
-        job.set(
-            diff=[
-                f"E4001: There was a problem capturing packages and resources for metadata"
-            ]
+    except Exception:
+        logger.exception("There was a problem capturing packages or resources.")
+        linkage_results = [[diff_error_message]] * len(verified)
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+    for job, job_results in zip(verified, linkage_results):
+        job.set(diff=job_results)
+    return job_uuids
+
+
+@shared_task(bind=True)
+def prime_archive_cache(self, importer):
+    """
+    fetch the archive metadata for `importer` and compute its prior state, so
+    the first job for the importer finds both already cached
+    """
+    logger = logging.getLogger("rainbow")
+    cls = registry.get_importer(importer)
+
+    def prior_metadata(logger):
+        return DownloadMetadata(logger, cls, path=snapshot_path)
+
+    with archive_snapshot(logger, importer, cls) as snapshot_path:
+        memoized_prior_state(
+            snapshot_path,
+            lambda: generate_state("prime.{}".format(importer), prior_metadata)[1],
+            cls.resource_linkage,
         )
-    return job_uuid
+    return importer
 
 
 @shared_task(bind=True)
+@instrumented("complete")
 def validate_complete(self, job_uuid):
     """
     Clean up after validation is complete for the job (even if unsuccessful)
 
     Signal state to front end to stop polling server
     """
-    job = VerificationJob.objects.get(uuid=job_uuid)
+    job = VerificationJob.objects.without_uploads().get(uuid=job_uuid)
     paths = job.state["path_info"]
     job.set(complete=True)
     for fpath in paths.values():
         os.unlink(fpath)
-    os.rmdir(job.state["temp_path"])
+    shutil.rmtree(job.state["temp_path"])
     return job_uuid
 
 
+@shared_task
+def forget_result(result_key):
+    """
+    errback for a job's pipeline: a job which failed mustn't be handed to
+    identical submissions
+    """
+    resultcache.forget(result_key)
+
+
+def cancel_validation(job_uuid):
+    """
+    cancel a job which has been superseded by a later submission. the job's
+    tasks check for cancellation before doing any costly work, so the rest of
+    its pipeline runs through quickly and `validate_complete` still cleans up
+    its workspace. a job whose results have been handed to an identical
+    submission is left to run. returns whether the job was cancelled.
+    """
+    logger = logging.getLogger("rainbow")
+    try:
+        job = VerificationJob.objects.without_uploads().get(uuid=job_uuid)
+    except VerificationJob.DoesNotExist:
+        return False
+    if job.state.get("complete") or job.state.get("shared"):
+        return False
+    job.set(cancelled=True)
+    if "result_key" in job.state:
+        resultcache.forget(job.state["result_key"])
+    logger.info("Job {} superseded, cancelling.".format(job_uuid))
+    return True
+
+
 # be a little bit paranoid; this matches every file in the existing archive
 valid_filename = re.compile(r"^[A-Za-z0-9_\- .()]+\.(md5|xlsx)$")
 
+# importers scored by the time of their last submission, to pick the archives
+# worth warming
+recent_importers_key = "bpaworkflow:importers:recent"
 
-def invoke_validation(importer, files):
+
+def importer_used(importer):
+    "record a submission for `importer`, for `recent_importers`"
+    try:
+        redis_client.zadd(recent_importers_key, {importer: time.time()})
+    except redis.RedisError as e:
+        logging.getLogger("rainbow").error(
+            "Unable to record importer use: %s" % (repr(e))
+        )
+
+
+def recent_importers(seconds):
+    "the importers with a submission within the last `seconds`"
+    try:
+        used = redis_client.zrangebyscore(
+            recent_importers_key, time.time() - seconds, "+inf"
+        )
+        return set(t.decode("utf8") for t in used)
+    except redis.RedisError as e:
+        logging.getLogger("rainbow").error(
+            "Unable to read recent importers: %s" % (repr(e))
+        )
+        return set()
+
+
+def invoke_validation(importer, files, upload_ids={}):
+    """
+    the MD5 and XLSX files are either in `files`, or were uploaded in chunks
+    and are identified by `upload_ids`
+    """
     logger = logging.getLogger("rainbow")
 
     def get_filename(key):
@@ -252,33 +610,124 @@ def invoke_validation(importer, files):
             raise HttpResponseForbidden()
         return name
 
-    def read_file(key):
-        size = 0
-        buf = []
-        file_obj = files[key]
-        for chunk in file_obj.chunks():
-            size += len(chunk)
-            if size > settings.VERIFICATION_MAX_SIZE:
-                raise HttpResponseForbidden()
-            buf.append(chunk)
-        return b"".join(buf)
+    def store_file(key):
+        digest = uploads.store_chunks(
+            files[key].chunks(), uploads.max_size(files[key].name)
+        )
+        if digest is None:
+            raise HttpResponseForbidden()
+        return digest
+
+    def get_upload(key):
+        if key in upload_ids:
+            return uploads.completed_upload(upload_ids[key])
+        return get_filename(key), store_file(key)
 
     logger.info("Starting verification job process...")
+    importer_used(importer)
+    md5_name, md5_sha256 = get_upload("md5")
+    xlsx_name, xlsx_sha256 = get_upload("xlsx")
+
+    result_key = resultcache.submission_key(
+        importer, [(xlsx_name, xlsx_sha256), (md5_name, md5_sha256)]
+    )
+    job_uuid = resultcache.lookup(result_key)
+    if job_uuid is not None:
+        logger.info("Identical to submission {}, reusing its results.".format(job_uuid))
+        # a later submission from the first submitter mustn't cancel the job
+        VerificationJob.mark_shared(job_uuid)
+        return job_uuid
+
     job = VerificationJob.create(
         importer=importer,
-        md5_name=get_filename("md5"),
-        md5_data=read_file("md5"),
-        xlsx_name=get_filename("xlsx"),
-        xlsx_data=read_file("xlsx"),
+        md5_name=md5_name,
+        md5_sha256=md5_sha256,
+        xlsx_name=xlsx_name,
+        xlsx_sha256=xlsx_sha256,
     )
-    job.set(complete=False)
+    job.set(complete=False, result_key=result_key)
+    resultcache.register(result_key, job.uuid)
+    resultcache.record_progress(job.uuid)
     logger.info("Job initialisation completed.")
-    (
-        validation_setup.s()
-        | validate_spreadsheet.s()
-        | validate_md5.s()
-        | validate_bpaingest_json.s()
-        | validate_complete.s()
-    ).delay(job.uuid)
+    make_pipeline().apply_async((job.uuid,), link_error=forget_result.si(result_key))
 
     return job.uuid
+
+
+def invoke_batch_validation(importer, files):
+    """
+    verify a batch of submissions, the files of which are in `files` (see
+    `batches.batch_files`); returns the batch ID, and the job of each pair
+    of files
+    """
+    logger = logging.getLogger("rainbow")
+    importer_used(importer)
+    stored = {}
+    for name, chunks in batches.batch_files(files):
+        if not valid_filename.match(name):
+            raise uploads.UploadError("invalid filename: {}".format(name))
+        if name in stored:
+            raise uploads.UploadError("more than one file named {}".format(name))
+        digest = uploads.store_chunks(chunks, uploads.max_size(name))
+        if digest is None:
+            raise uploads.UploadError("{} is too large".format(name))
+        stored[name] = digest
+    pairs = batches.pair_files(stored)
+    if not pairs:
+        raise uploads.UploadError("no files were submitted")
+
+    batch_id = str(uuid.uuid4())
+    jobs = {}
+    for name, pair in sorted(pairs.items()):
+        job = VerificationJob.create(
+            importer=importer,
+            md5_name=pair["md5"],
+            md5_sha256=stored[pair["md5"]],
+            xlsx_name=pair["xlsx"],
+            xlsx_sha256=stored[pair["xlsx"]],
+        )
+        job.set(complete=False, batch=batch_id)
+        jobs[name] = job.uuid
+    batches.record_batch(batch_id, importer, jobs)
+    logger.info("Batch {} of {} submissions initialised.".format(batch_id, len(jobs)))
+    make_batch_pipeline(batch_id, list(jobs.values())).delay()
+    return batch_id, jobs
+
+
+def make_batch_pipeline(batch_id, job_uuids):
+    """
+    the quick checks of the jobs in a batch run concurrently with each other,
+    and the bpaingest diff runs once they are all done. each job is then
+    cleaned up.
+    """
+    return chord(
+        [
+            validation_setup.si(job_uuid) | validate_spreadsheet.s() | validate_md5.s()
+            for job_uuid in job_uuids
+        ],
+        validate_batch_diff.s(batch_id),
+    ) | group([validate_complete.si(job_uuid) for job_uuid in job_uuids])
+
+
+def make_pipeline():
+    """
+    the spreadsheet and MD5 checks are independent of each other, so by default
+    they run concurrently; the bpaingest diff waits on both, as it is only
+    run if they are free of errors
+    """
+    if settings.VERIFICATION_PIPELINE == "chain":
+        return (
+            validation_setup.s()
+            | validate_spreadsheet.s()
+            | validate_md5.s()
+            | validate_bpaingest_json.s()
+            | validate_complete.s()
+        )
+    return (
+        validation_setup.s()
+        | chord(
+            group(validate_spreadsheet.s(), validate_md5.s()),
+            validate_bpaingest_json.s(),
+        )
+        | validate_complete.s()
+    )
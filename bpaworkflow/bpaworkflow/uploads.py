@@ -0,0 +1,206 @@
+"""
+content-addressed store of uploaded files.
+
+uploads are streamed to disk as they are hashed, and are stored by the SHA-256
+digest of their content. the store lives under CELERY_DATADIR, which is shared
+by the web and worker processes, so jobs refer to their uploads by digest and
+the workers read them in place.
+
+large files are uploaded in chunks, which are appended to a spool file in
+order; if a transfer is interrupted, the client asks how much of the file has
+been received, and carries on from there. once the last chunk is received the
+spool file is moved into the store.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+import uuid
+from contextlib import suppress
+
+from django.conf import settings
+
+
+def store_root():
+    return settings.VERIFICATION_UPLOAD_DIR
+
+
+def store_path(digest):
+    return os.path.join(store_root(), digest[:2], digest)
+
+
+def store_spooled(path):
+    """
+    move the file at `path` into the store, returning its digest
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(1 << 20), b""):
+            h.update(chunk)
+    os.chmod(path, 0o644)
+    digest = h.hexdigest()
+    target = store_path(digest)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.replace(path, target)
+    return digest
+
+
+def store_chunks(chunks, max_size):
+    """
+    write the byte strings in `chunks` to the store, returning the digest of
+    the content; or None if it is larger than `max_size` bytes
+    """
+    tmp_dir = os.path.join(store_root(), "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        h = hashlib.sha256()
+        size = 0
+        with os.fdopen(fd, "wb") as out:
+            for chunk in chunks:
+                size += len(chunk)
+                if size > max_size:
+                    return None
+                h.update(chunk)
+                out.write(chunk)
+        # mkstemp creates the file readable only by its owner
+        os.chmod(tmp_path, 0o644)
+        digest = h.hexdigest()
+        path = store_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # if identical content is already stored, this replaces it
+        os.replace(tmp_path, path)
+        return digest
+    finally:
+        with suppress(FileNotFoundError):
+            os.unlink(tmp_path)
+
+
+def max_size(name):
+    "the largest file named `name` which may be uploaded, in bytes"
+    if (
+        name.lower().endswith(".xlsx")
+        and settings.VERIFICATION_XLSX_READER != "streaming"
+    ):
+        return settings.VERIFICATION_MAX_XLSX_SIZE
+    return settings.VERIFICATION_MAX_SIZE
+
+
+class UploadError(Exception):
+    pass
+
+
+valid_upload_id = re.compile(r"^[0-9a-f]{32}$")
+
+
+def spool_root():
+    return os.path.join(store_root(), "spool")
+
+
+def spool_path(upload_id):
+    if not valid_upload_id.match(upload_id):
+        raise UploadError("invalid upload")
+    return os.path.join(spool_root(), upload_id)
+
+
+def read_upload(upload_id):
+    try:
+        with open(spool_path(upload_id) + ".json") as fd:
+            return json.load(fd)
+    except FileNotFoundError:
+        raise UploadError("unknown upload")
+
+
+def write_upload(upload_id, upload):
+    path = spool_path(upload_id) + ".json"
+    with open(path + ".tmp", "w") as fd:
+        json.dump(upload, fd)
+    os.replace(path + ".tmp", path)
+
+
+def expire_uploads():
+    """
+    remove uploads which were abandoned, or completed and never submitted
+    """
+    for name in os.listdir(spool_root()):
+        path = os.path.join(spool_root(), name)
+        with suppress(OSError):
+            if time.time() - os.stat(path).st_mtime > settings.VERIFICATION_UPLOAD_TTL:
+                os.unlink(path)
+
+
+def create_upload(name, size, max_size):
+    """
+    begin a chunked upload of a file named `name`, `size` bytes long; returns
+    the upload ID
+    """
+    if size > max_size:
+        raise UploadError("file is too large")
+    os.makedirs(spool_root(), exist_ok=True)
+    expire_uploads()
+    upload_id = uuid.uuid4().hex
+    open(spool_path(upload_id), "wb").close()
+    write_upload(upload_id, {"name": name, "size": size, "sha256": None})
+    return upload_id
+
+
+def upload_status(upload_id):
+    """
+    returns the name of the upload, its total size, the number of bytes
+    received so far and, once complete, the digest of its content
+    """
+    upload = read_upload(upload_id)
+    received = upload["size"]
+    if upload["sha256"] is None:
+        try:
+            received = os.stat(spool_path(upload_id)).st_size
+        except FileNotFoundError:
+            raise UploadError("unknown upload")
+    return dict(upload, upload_id=upload_id, received=received)
+
+
+def append_chunk(upload_id, start, chunks):
+    """
+    append the byte strings in `chunks`, which begin at offset `start` of the
+    uploaded file. a chunk which doesn't begin where the spool file ends is
+    ignored; the status returned tells the client where to resume from.
+    """
+    upload = read_upload(upload_id)
+    if upload["sha256"] is not None:
+        return upload_status(upload_id)
+    path = spool_path(upload_id)
+    try:
+        fd = open(path, "ab")
+    except FileNotFoundError:
+        raise UploadError("unknown upload")
+    with fd:
+        # a client may retry a chunk while the original request is in flight
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        received = os.fstat(fd.fileno()).st_size
+        if start != received:
+            return upload_status(upload_id)
+        for chunk in chunks:
+            received += len(chunk)
+            if received > upload["size"]:
+                fd.truncate(start)
+                raise UploadError("upload is larger than declared")
+            fd.write(chunk)
+        fd.flush()
+        if received == upload["size"]:
+            upload["sha256"] = store_spooled(path)
+            write_upload(upload_id, upload)
+    return upload_status(upload_id)
+
+
+def completed_upload(upload_id):
+    """
+    returns (name, sha256) of a completed upload
+    """
+    upload = read_upload(upload_id)
+    if upload["sha256"] is None:
+        raise UploadError("upload is incomplete")
+    return upload["name"], upload["sha256"]
@@ -11,4 +11,9 @@ urlpatterns = [
     url(r"^private/api/v1/metadata$", views.metadata, name="metadata"),
     url(r"^private/api/v1/validate$", views.validate, name="validate"),
     url(r"^private/api/v1/status$", views.status, name="status"),
+    url(r"^private/api/v1/status/wait$", views.status_wait, name="status_wait"),
+    url(r"^private/api/v1/upload$", views.upload, name="upload"),
+    url(r"^private/api/v1/batch$", views.batch, name="batch"),
+    url(r"^private/api/v1/batch/status$", views.batch_status, name="batch_status"),
+    url(r"^private/api/v1/metrics$", views.metrics_endpoint, name="metrics"),
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
@@ -1,11 +1,17 @@
 import logging
 import os
-from functools import wraps
+import re
+import time
+import zipfile
+from contextlib import suppress
+from functools import lru_cache, wraps
 
 from xlrd import XLRDError
 
 from bpaingest.libs.excel_wrapper import ExcelWrapper
-from bpaingest.dump import linkage_qc
+from bpaingest.libs.md5lines import md5lines
+
+from .spreadsheet import check_rows, compile_schema, row_writer, save_rows
 
 logger = logging.getLogger("rainbow")
 
@@ -30,6 +36,9 @@ def linkage_collector(errors_collection):
 
 @exceptions_to_error
 def collect_linkage_dump_linkage(logger, diff_state, post_data_type_meta):
+    # bpaingest.dump imports every importer module; see the registry
+    from bpaingest.dump import linkage_qc
+
     errors_collection = []
     collector = linkage_collector(errors_collection)
     linkage_qc(logger, diff_state, post_data_type_meta, collector)
@@ -37,7 +46,10 @@ def collect_linkage_dump_linkage(logger, diff_state, post_data_type_meta):
 
 
 @exceptions_to_error
-def verify_spreadsheet(logging, cls, fpath, metadata_info):
+def verify_spreadsheet(logging, cls, fpath, metadata_info, rows_path=None):
+    """
+    if there are no errors, the parsed rows are saved to `rows_path`
+    """
     kwargs = cls.spreadsheet["options"]
     try:
         wrapper = ExcelWrapper(
@@ -53,11 +65,187 @@ def verify_spreadsheet(logging, cls, fpath, metadata_info):
             "E3003: The provided spreadsheet could not be read: %s" % str(e),
             "Please ensure the spreadsheet is in Microsoft Excel (XLSX) format.",
         ]
-    return wrapper.get_errors()
+    errors = wrapper.get_errors()
+    if rows_path is not None and not errors:
+        # problems logged while reading the rows aren't reported, as before the
+        # rows were saved; bpaingest ingests the rows regardless of them. if the
+        # rows can't be read, the bpaingest diff parses the spreadsheet itself.
+        try:
+            rows = list(wrapper.get_all())
+        except Exception as e:
+            logger.warning("Unable to save spreadsheet rows: %s" % (repr(e)))
+        else:
+            save_rows(rows_path, rows[0]._fields if rows else [], rows)
+    return errors
+
+
+@exceptions_to_error
+def verify_spreadsheet_streaming(
+    logger, cls, fpath, metadata_info, max_errors=None, rows_path=None
+):
+    """
+    as for `verify_spreadsheet`, but reading the spreadsheet a row at a time
+    """
+    schema = compile_schema(cls)
+    additional_context = metadata_info[os.path.basename(fpath)]
+    names = schema.names + list(additional_context)
+    context_values = list(additional_context.values())
+
+    def check(on_row):
+        try:
+            return check_rows(
+                logger, schema, fpath, max_errors=max_errors, on_row=on_row
+            )
+        except (zipfile.BadZipFile, KeyError, XLRDError) as e:
+            return [
+                "E3003: The provided spreadsheet could not be read: %s" % str(e),
+                "Please ensure the spreadsheet is in Microsoft Excel (XLSX) format.",
+            ]
+
+    if rows_path is None:
+        return check(None)
+    # the rows are written as they are read, and only kept if there are no errors
+    tmp_path = rows_path + ".tmp"
+    try:
+        with row_writer(tmp_path, names) as write:
+            errors = check(lambda values: write(values + context_values))
+        if not errors:
+            os.replace(tmp_path, rows_path)
+    finally:
+        with suppress(FileNotFoundError):
+            os.unlink(tmp_path)
+    return errors
+
+
+# flags which can be scoped to part of a regular expression
+scoped_flags = (
+    (re.IGNORECASE, "i"),
+    (re.MULTILINE, "m"),
+    (re.DOTALL, "s"),
+    (re.VERBOSE, "x"),
+)
+unscoped_flags = re.ASCII | re.LOCALE | re.DEBUG
+inline_flags = re.compile(r"^\(\?[aiLmsux]+\)")
+named_group = re.compile(r"\(\?P<[A-Za-z_][A-Za-z0-9_]*>")
+backreference = re.compile(r"\(\?P=|\\[1-9]")
+
+
+def combine_regexps(regexps):
+    """
+    combine `regexps` into a single alternation, with a group named for the
+    index of each; returns None if they can't be combined. named groups
+    within each are made non-capturing, so that names used by more than one
+    regexp don't clash.
+    """
+    alternatives = []
+    for i, regexp in enumerate(regexps):
+        if regexp.flags & unscoped_flags or backreference.search(regexp.pattern):
+            return None
+        flags = "".join(c for (flag, c) in scoped_flags if regexp.flags & flag)
+        # global inline flags are included in regexp.flags
+        pattern = inline_flags.sub("", regexp.pattern)
+        pattern = named_group.sub("(?:", pattern)
+        if flags:
+            pattern = "(?%s:%s)" % (flags, pattern)
+        alternatives.append("(?P<_c%d>%s)" % (i, pattern))
+    try:
+        return re.compile("|".join(alternatives))
+    except re.error:
+        return None
+
+
+def convention_matcher(regexps):
+    """
+    returns a function which, given a filename, returns the index of the first
+    of `regexps` which matches it, or None
+    """
+    regexps = [re.compile(t) for t in regexps]
+    combined = combine_regexps(regexps) if regexps else None
+
+    def match_each(s):
+        for i, regexp in enumerate(regexps):
+            if regexp.match(s):
+                return i
+        return None
+
+    def match_combined(s):
+        m = combined.match(s)
+        if m is None:
+            return None
+        return int(m.lastgroup[2:])
+
+    if combined is None:
+        return match_each
+    return match_combined
+
+
+@lru_cache(maxsize=None)
+def md5_matchers(cls):
+    """
+    the matchers for the filename conventions of `cls`, and the files it
+    skips; compiled once per process
+    """
+    skip = cls.md5["skip"]
+    return (
+        convention_matcher(cls.md5["match"]),
+        convention_matcher(skip) if skip is not None else None,
+    )
+
+
+def md5_errors(cls, fd):
+    """
+    yields an error for each file listed in the MD5 file `fd` which does not
+    meet the filename conventions of `cls`, as it is read
+    """
+    match, skip = md5_matchers(cls)
+    for md5, path in md5lines(fd):
+        match_path = path.split("/")[-1]
+        if skip is not None and skip(match_path) is not None:
+            continue
+        if match(match_path) is None:
+            yield "E2001: File does not meet convention: `%s'" % path
 
 
 @exceptions_to_error
-def verify_md5file(logger, cls, fpath):
-    instance = cls(logger, "/dev/null")
-    p = instance.parse_md5file_unwrapped(fpath)
-    return ["E2001: File does not meet convention: `%s'" % t for t in p.no_match]
+def verify_md5file(logger, cls, fpath, report=None, max_errors=None, interval=2):
+    """
+    the MD5 file is read line by line. errors found so far are passed to
+    `report`, no more than once every `interval` seconds; after `max_errors`
+    errors, the rest are counted rather than listed.
+    """
+    errors = []
+    suppressed = 0
+    last_report = None
+    with open(fpath) as fd:
+        for error in md5_errors(cls, fd):
+            if max_errors is not None and len(errors) >= max_errors:
+                suppressed += 1
+                continue
+            errors.append(error)
+            now = time.monotonic()
+            if report is not None and (
+                last_report is None or now - last_report >= interval
+            ):
+                report(list(errors))
+                last_report = now
+    if suppressed:
+        errors.append(
+            "A further %d files do not meet convention, and are not listed."
+            % suppressed
+        )
+    return errors
+
+
+def warm_caches(classes):
+    """
+    compile the spreadsheet schema and MD5 filename matchers of each importer
+    in `classes`, so that jobs don't have to
+    """
+    for cls in classes:
+        try:
+            if hasattr(cls, "spreadsheet"):
+                compile_schema(cls)
+            if hasattr(cls, "md5"):
+                md5_matchers(cls)
+        except Exception as e:
+            logger.error("Unable to compile schema for %s: %s" % (cls, repr(e)))
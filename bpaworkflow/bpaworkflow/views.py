@@ -1,18 +1,28 @@
+import gzip
+import hashlib
+import io
+import json
 import logging
+import re
 from collections import defaultdict
+from functools import lru_cache
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.views.decorators.http import require_http_methods
 from django.views.generic import TemplateView
 from django.views.decorators.csrf import csrf_exempt
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
+from django.utils.cache import (
+    get_conditional_response,
+    patch_cache_control,
+    patch_vary_headers,
+)
 
-from bpaingest.projects import ProjectInfo
 from bpaingest.organizations import ORGANIZATIONS
-from . import tasks
+from . import batches, metrics, registry, tasks, uploads
 from .models import VerificationJob
 
 logger = logging.getLogger("rainbow")
-project_info = ProjectInfo()
 
 
 # convenience method
@@ -43,27 +53,28 @@ class WorkflowIndex(TemplateView):
     def get_context_data(self, **kwargs):
         context = super(WorkflowIndex, self).get_context_data(**kwargs)
         context["ckan_base_url"] = settings.CKAN_SERVER["base_url"]
+        context["upload_chunk_size"] = settings.VERIFICATION_UPLOAD_CHUNK_SIZE
+        context["status_wait"] = settings.VERIFICATION_STATUS_WAIT > 0
         return context
 
 
-@require_http_methods(["GET"])
-def metadata(request):
+@lru_cache(maxsize=None)
+def metadata_response():
     """
-    private API: given taxonomy constraints, return the possible options
+    the importers which can be verified don't change while the process is
+    running, so the response is built once. returns (body, gzipped body, etag).
     """
     by_organization = defaultdict(list)
-    logger.info(f"at beginning by_organization is: {by_organization}")
     for info in filter(
-        lambda x: has_its_own_active_ingest(x["cls"]), project_info.metadata_info
+        lambda x: has_its_own_active_ingest(x["cls"]), registry.metadata_info()
     ):
         obj = dict(
             (t, info[t])
             for t in ("slug", "omics", "technology", "analysed", "pool", "project")
         )
         by_organization[info["organization"]].append(obj)
-    logger.info("have by organization...")
-    logger.info(f"{by_organization}")
-    return JsonResponse(
+    logger.debug(f"importers by organization: {by_organization}")
+    body = json.dumps(
         {
             "importers": by_organization,
             "projects": dict(
@@ -71,8 +82,40 @@ def metadata(request):
                 for t in ORGANIZATIONS
                 if t["name"] in by_organization
             ),
-        }
-    )
+        },
+        cls=DjangoJSONEncoder,
+    ).encode("utf8")
+    # mtime=0, so the compressed body is the same in every process
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb", mtime=0) as fd:
+        fd.write(body)
+    gzipped = buf.getvalue()
+    return body, gzipped, hashlib.sha256(body).hexdigest()
+
+
+accepts_gzip = re.compile(r"\bgzip\b")
+
+
+@require_http_methods(["GET"])
+def metadata(request):
+    """
+    private API: given taxonomy constraints, return the possible options
+    """
+    body, gzipped, digest = metadata_response()
+    use_gzip = accepts_gzip.search(request.META.get("HTTP_ACCEPT_ENCODING", ""))
+    # each encoding of the response has its own strong ETag
+    etag = '"{}{}"'.format(digest, "-gzip" if use_gzip else "")
+    # not modified, if the client already holds this encoding of the response
+    response = get_conditional_response(request, etag=etag)
+    if response is None and use_gzip:
+        response = HttpResponse(gzipped, content_type="application/json")
+        response["Content-Encoding"] = "gzip"
+    elif response is None:
+        response = HttpResponse(body, content_type="application/json")
+    response["ETag"] = etag
+    patch_cache_control(response, max_age=settings.VERIFICATION_METADATA_MAX_AGE)
+    patch_vary_headers(response, ("Accept-Encoding",))
+    return response
 
 
 @require_http_methods(["POST"])
@@ -82,14 +125,113 @@ def validate(request):
     """
 
     importer = request.POST["importer"]
-    cls = project_info.cli_options().get(importer)
+    cls = registry.get_importer(importer)
     if not cls or not metadata_verifyable(cls):
         return JsonResponse({"error": "invalid submission"})
 
-    submission_id = tasks.invoke_validation(importer, request.FILES)
+    upload_ids = dict(
+        (key, request.POST[key + "_upload"])
+        for key in ("md5", "xlsx")
+        if key + "_upload" in request.POST
+    )
+    try:
+        submission_id = tasks.invoke_validation(importer, request.FILES, upload_ids)
+    except uploads.UploadError as e:
+        return JsonResponse({"error": str(e)})
+    # a resubmission of a spreadsheet (by name) supersedes the user's previous
+    # submission of it, the results of which will never be read. a job reached
+    # through the result cache belongs to an earlier submitter, and isn't
+    # recorded, so it is never cancelled on this user's behalf.
+    job = VerificationJob.objects.without_uploads().get(uuid=submission_id)
+    if not job.state.get("shared"):
+        session_key = "submission:{}:{}".format(importer, job.xlsx_name)
+        previous_id = request.session.get(session_key)
+        if previous_id and previous_id != submission_id:
+            tasks.cancel_validation(previous_id)
+        request.session[session_key] = submission_id
     return JsonResponse({"submission_id": submission_id})
 
 
+@require_http_methods(["POST"])
+def batch(request):
+    """
+    private API: validate a batch of submissions for a given importer, either
+    as a zip file (`zip`) or as any number of `xlsx` and `md5` files. each
+    spreadsheet is paired with the MD5 file named alike up to the last
+    underscore.
+    """
+
+    importer = request.POST["importer"]
+    cls = registry.get_importer(importer)
+    if not cls or not metadata_verifyable(cls):
+        return JsonResponse({"error": "invalid submission"})
+
+    try:
+        batch_id, jobs = tasks.invoke_batch_validation(importer, request.FILES)
+    except uploads.UploadError as e:
+        return JsonResponse({"error": str(e)})
+    return JsonResponse({"batch_id": batch_id, "submissions": jobs})
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def batch_status(request):
+    """
+    private API: get the current status of each submission in a batch
+    """
+    status = batches.batch_status(request.POST["batch_id"])
+    if status is None:
+        return JsonResponse({"error": "unknown batch"}, status=404)
+    return JsonResponse(status)
+
+
+content_range = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+
+
+@require_http_methods(["GET", "POST"])
+def upload(request):
+    """
+    private API: chunked, resumable upload of a file for verification.
+
+    a POST with `name` and `size` begins an upload, returning its ID. each
+    chunk is then POSTed with `upload_id`, a `file` part and a Content-Range
+    header. a GET with `upload_id` returns the number of bytes received, from
+    which an interrupted upload is resumed.
+    """
+
+    def upload_response(status):
+        response = JsonResponse(status)
+        # jquery.fileupload resumes from the end of this range
+        if status["received"]:
+            response["Range"] = "bytes=0-{}".format(status["received"] - 1)
+        return response
+
+    try:
+        if request.method == "GET":
+            return upload_response(uploads.upload_status(request.GET["upload_id"]))
+
+        upload_id = request.POST.get("upload_id")
+        if upload_id is None:
+            try:
+                name = request.POST["name"]
+                size = int(request.POST["size"])
+            except (KeyError, ValueError):
+                raise uploads.UploadError("name and size are required")
+            if not tasks.valid_filename.match(name):
+                raise uploads.UploadError("invalid filename")
+            upload_id = uploads.create_upload(name, size, uploads.max_size(name))
+            return upload_response(uploads.upload_status(upload_id))
+
+        chunk = request.FILES["file"]
+        match = content_range.match(request.META.get("HTTP_CONTENT_RANGE", ""))
+        start = int(match.group(1)) if match else 0
+        return upload_response(uploads.append_chunk(upload_id, start, chunk.chunks()))
+    except uploads.UploadError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    except KeyError as e:
+        return JsonResponse({"error": "missing {}".format(e)}, status=400)
+
+
 @csrf_exempt
 @require_http_methods(["POST"])
 def status(request):
@@ -97,13 +239,35 @@ def status(request):
     private API: get the current status of a validation task
     """
     job_uuid = request.POST["submission_id"]
-    job = VerificationJob.objects.get(uuid=job_uuid)
-    return JsonResponse(
-        {
-            "submission_id": job.uuid,
-            "complete": job.state.get("complete"),
-            "md5": job.state.get("md5"),
-            "xlsx": job.state.get("xlsx"),
-            "diff": job.state.get("diff"),
-        }
+    status = VerificationJob.get_status(job_uuid)
+    return JsonResponse(dict(submission_id=job_uuid, **status))
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def status_wait(request):
+    """
+    private API: as for `status`, but waits until the status of the validation
+    task has changed since the given `version`. returns at once if waiting is
+    disabled (see VERIFICATION_STATUS_WAIT).
+    """
+    job_uuid = request.POST["submission_id"]
+    version = int(request.POST.get("version", 0))
+    if settings.VERIFICATION_STATUS_WAIT > 0:
+        status = VerificationJob.wait_status(
+            job_uuid, version, settings.VERIFICATION_STATUS_WAIT
+        )
+    else:
+        status = VerificationJob.get_status(job_uuid)
+    return JsonResponse(dict(submission_id=job_uuid, **status))
+
+
+@require_http_methods(["GET"])
+def metrics_endpoint(request):
+    """
+    private API: timing and resource use of the verification pipeline, by
+    importer and stage, in the Prometheus text format
+    """
+    return HttpResponse(
+        metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
     )
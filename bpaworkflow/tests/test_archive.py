@@ -0,0 +1,99 @@
+"""
+the incremental and full diff modes check a submission against the same part
+of the archive
+"""
+
+from bpaworkflow.archive import linkage_index, linkage_subset, submission_changes
+
+resource_linkage = ("sample_id",)
+
+
+def package(id, sample_id, **kwargs):
+    return dict(id=id, sample_id=sample_id, **kwargs)
+
+
+def resource(id, sample_id):
+    return (
+        (sample_id,),
+        "https://example.com/BPAOPS-1/{}.fastq.gz".format(id),
+        {"id": id},
+    )
+
+
+def state(packages, resources):
+    return {
+        "test-data-type": {
+            "packages": sorted(packages, key=lambda x: x["id"]),
+            "resources": sorted(resources, key=lambda x: x[2]["id"]),
+        }
+    }
+
+
+archive_packages = [package("p1", 1), package("p2", 2), package("p3", 3)]
+archive_resources = [resource("r1", 1), resource("r2", 2), resource("r3", 3)]
+# a second package for sample 2, a resource without a package, an update to p3,
+# and p1 as it is in the archive
+submission_packages = [
+    package("s2", 2),
+    package("p3", 3, title="updated"),
+    package("p1", 1),
+]
+submission_resources = [resource("s2", 2), resource("s9", 9)]
+
+
+def diff_states():
+    prior_state = state(archive_packages, archive_resources)
+    prior_index = linkage_index(prior_state, resource_linkage)
+    # the archive as the submission leaves it
+    post_state = state(
+        [t for t in archive_packages if t["id"] != "p3"] + submission_packages,
+        archive_resources + submission_resources,
+    )
+    incremental_state = state(submission_packages, submission_resources)
+    incremental = linkage_subset(
+        prior_index,
+        submission_changes(prior_index, incremental_state, resource_linkage),
+        resource_linkage,
+    )
+    full = linkage_subset(
+        linkage_index(post_state, resource_linkage),
+        submission_changes(prior_index, post_state, resource_linkage),
+        resource_linkage,
+    )
+    return incremental, full
+
+
+def test_linkage_index():
+    index = linkage_index(
+        state(archive_packages + [package("p4", 1)], archive_resources),
+        resource_linkage,
+    )["test-data-type"]
+    assert sorted(index["packages"]) == [(1,), (2,), (3,)]
+    assert [t["id"] for t in index["packages"][(1,)]] == ["p1", "p4"]
+    assert [t[2]["id"] for t in index["resources"][(2,)]] == ["r2"]
+
+
+def test_submission_changes():
+    prior_index = linkage_index(
+        state(archive_packages, archive_resources), resource_linkage
+    )
+    changes = submission_changes(
+        prior_index, state(submission_packages, submission_resources), resource_linkage,
+    )["test-data-type"]
+    assert [t["id"] for t in changes["packages"]] == ["p3", "s2"]
+    assert [t[2]["id"] for t in changes["resources"]] == ["s2", "s9"]
+    assert submission_changes(prior_index, {}, resource_linkage) == {}
+
+
+def test_modes_agree():
+    incremental, full = diff_states()
+    assert incremental == full
+    subset = full["test-data-type"]
+    # the conflicting package of the archive is checked along with the
+    # submission; the updated package replaces the archive's
+    assert subset["packages"] == [
+        package("p2", 2),
+        package("p3", 3, title="updated"),
+        package("s2", 2),
+    ]
+    assert [t[2]["id"] for t in subset["resources"]] == ["r2", "r3", "s2", "s9"]
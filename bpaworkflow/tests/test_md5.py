@@ -0,0 +1,132 @@
+"""
+the combined filename convention matcher agrees with matching each convention
+in turn
+"""
+
+import io
+import os
+import re
+
+import pytest
+
+from bpaworkflow import registry
+from bpaworkflow.validate import (
+    combine_regexps,
+    convention_matcher,
+    md5_errors,
+    verify_md5file,
+)
+
+test_data = os.path.join(os.path.dirname(__file__), "test_data")
+md5_path = os.path.join(test_data, "79639_GAP_AGRF_PAE47351_checksums.md5")
+
+
+def match_each(regexps, s):
+    "the index of the first of `regexps` matching `s`, as bpaingest finds it"
+    for i, regexp in enumerate(regexps):
+        if re.match(regexp, s):
+            return i
+    return None
+
+
+def sample_filenames():
+    with open(md5_path) as fd:
+        names = [t.split(None, 1)[1].strip() for t in fd if t.strip()]
+    # near misses of the conventions, as well as the files themselves
+    return names + [
+        t
+        for name in names
+        for t in (name.upper(), name.replace("_", "-"), name + ".gz", "x" + name)
+    ]
+
+
+@pytest.mark.parametrize(
+    "regexps,names",
+    [
+        # the first matching convention is reported, where more than one match
+        ([r"^a", r"^ab", r"^abc$"], ["abc", "ab", "b", ""]),
+        ([r"^abc$", r"^ab", r"^a"], ["abc", "ab", "a", "b"]),
+        # named groups may be repeated between conventions
+        (
+            [r"(?P<id>\d+)_a\.tar$", r"(?P<id>\d+)_b\.tar$"],
+            ["1_a.tar", "2_b.tar", "3_c.tar"],
+        ),
+        # flags apply to their own convention only
+        ([r"(?i)^abc$", r"^ABD$"], ["ABC", "abd", "ABD"]),
+        ([re.compile(r"^x y$", re.VERBOSE), r"^x y$"], ["xy", "x y"]),
+        ([re.compile(r"^abc$", re.IGNORECASE), r"^ABD$"], ["AbC", "abd"]),
+        # conventions which can't be combined are matched in turn
+        ([r"^(a)\1$", r"^b"], ["aa", "ab", "b"]),
+        ([re.compile(r"^\w+$", re.ASCII), r"^."], ["abc", "é"]),
+        ([], ["abc"]),
+    ],
+)
+def test_convention_matcher(regexps, names):
+    match = convention_matcher(regexps)
+    for name in names:
+        assert match(name) == match_each(regexps, name), name
+
+
+def test_uncombinable():
+    assert combine_regexps([re.compile(r"^(a)\1$")]) is None
+    assert combine_regexps([re.compile(r"^(?P<x>a)(?P=x)$")]) is None
+    assert combine_regexps([re.compile(r"^a$", re.ASCII)]) is None
+
+
+@pytest.mark.parametrize(
+    "slug",
+    sorted(
+        slug
+        for slug, cls in registry.importers().items()
+        if getattr(cls, "md5", None) is not None
+    ),
+)
+def test_importer_conventions(slug):
+    cls = registry.importers()[slug]
+    match = convention_matcher(cls.md5["match"])
+    for name in sample_filenames():
+        assert match(name) == match_each(cls.md5["match"], name), name
+    if cls.md5["skip"] is not None:
+        skip = convention_matcher(cls.md5["skip"])
+        for name in sample_filenames():
+            assert skip(name) == match_each(cls.md5["skip"], name), name
+
+
+class Importer:
+    md5 = {
+        "match": [re.compile(r"^(?P<id>\d+)_(?P<kind>fastq|bam)$")],
+        "skip": [re.compile(r"^.*\.txt$")],
+    }
+
+
+def test_md5_errors():
+    fd = io.StringIO(
+        "d41d8cd98f00b204e9800998ecf8427e  123_fastq\n"
+        "d41d8cd98f00b204e9800998ecf8427e  run/456_bam\n"
+        "d41d8cd98f00b204e9800998ecf8427e  notes.txt\n"
+        "d41d8cd98f00b204e9800998ecf8427e  run/789_fasta\n"
+    )
+    # a file is matched by its name, and reported by its path
+    assert list(md5_errors(Importer, fd)) == [
+        "E2001: File does not meet convention: `run/789_fasta'"
+    ]
+
+
+def test_verify_md5file():
+    cls = registry.get_importer("gap-ont-promethion")
+    assert verify_md5file(None, cls, md5_path) == []
+    # the test files don't meet the conventions of other importers, as for
+    # flagged/E2001_file_convention
+    other = registry.get_importer("gap-illumina-shortread")
+    errors = verify_md5file(None, other, md5_path)
+    with open(md5_path) as fd:
+        assert errors == [
+            "E2001: File does not meet convention: `%s'" % t.split(None, 1)[1].strip()
+            for t in fd
+            if t.strip()
+        ]
+    limited = verify_md5file(None, other, md5_path, max_errors=2)
+    assert limited == errors[:2] + [
+        "A further %d files do not meet convention, and are not listed."
+        % (len(errors) - 2)
+    ]
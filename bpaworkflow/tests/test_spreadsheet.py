@@ -0,0 +1,102 @@
+"""
+the streaming spreadsheet reader gives the same results as ExcelWrapper
+"""
+
+import glob
+import logging
+import os
+
+import pytest
+import xlrd
+
+from bpaworkflow import registry
+from bpaworkflow.spreadsheet import load_rows, open_sheet
+from bpaworkflow.validate import verify_spreadsheet, verify_spreadsheet_streaming
+
+test_data = os.path.join(os.path.dirname(__file__), "test_data")
+spreadsheets = sorted(
+    glob.glob(os.path.join(test_data, "**", "*.xlsx"), recursive=True)
+)
+logger = logging.getLogger("test")
+
+
+def spreadsheet_id(fpath):
+    return os.path.relpath(os.path.dirname(fpath), test_data)
+
+
+def metadata_info(fpath):
+    # as the pipeline fabricates it for an upload
+    return {
+        os.path.basename(fpath): {
+            "base_url": "https://example.com/does-not-exist/",
+            "ticket": "BPAOPS-99999",
+        }
+    }
+
+
+def trimmed(cells):
+    "a row's (type, value) pairs, without its trailing empty cells"
+    cells = [(t.ctype, t.value) for t in cells]
+    while cells and cells[-1][0] in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK):
+        cells.pop()
+    return cells
+
+
+@pytest.fixture(scope="module")
+def importer():
+    return registry.get_importer("gap-ont-promethion")
+
+
+@pytest.mark.parametrize("fpath", spreadsheets, ids=spreadsheet_id)
+def test_cells(fpath):
+    workbook = xlrd.open_workbook(fpath)
+    sheet = workbook.sheet_by_index(0)
+    with open_sheet(fpath) as (name, rows, datemode):
+        streamed = [trimmed(t) for t in rows]
+    assert name == sheet.name
+    assert datemode == workbook.datemode
+    assert streamed == [trimmed(sheet.row(i)) for i in range(sheet.nrows)]
+
+
+@pytest.mark.parametrize("fpath", spreadsheets, ids=spreadsheet_id)
+def test_errors_and_rows(importer, fpath, tmp_path):
+    info = metadata_info(fpath)
+    wrapper_rows = str(tmp_path / "wrapper")
+    streaming_rows = str(tmp_path / "streaming")
+    errors = verify_spreadsheet(logger, importer, fpath, info, rows_path=wrapper_rows)
+    assert (
+        verify_spreadsheet_streaming(
+            logger, importer, fpath, info, rows_path=streaming_rows
+        )
+        == errors
+    )
+    # rows are only kept for a spreadsheet without errors
+    assert os.path.exists(wrapper_rows) == (not errors)
+    assert os.path.exists(streaming_rows) == (not errors)
+    if not errors:
+        assert load_rows(streaming_rows) == load_rows(wrapper_rows)
+    assert sorted(os.listdir(str(tmp_path))) == sorted(
+        [] if errors else ["streaming", "wrapper"]
+    )
+
+
+def test_max_errors(importer):
+    fpath = os.path.join(
+        test_data,
+        "flagged",
+        "E3002_metadata_unmapped_column",
+        "79639_GAP_AGRF_PAE47351_metadata.xlsx",
+    )
+    errors = verify_spreadsheet_streaming(
+        logger, importer, fpath, metadata_info(fpath), max_errors=1
+    )
+    assert len(errors) == 2
+    assert errors[-1].startswith("Only the first 1 errors are listed")
+
+
+def test_unreadable(importer, tmp_path):
+    fpath = str(tmp_path / "not_a_spreadsheet.xlsx")
+    with open(fpath, "w") as fd:
+        fd.write("not a spreadsheet")
+    errors = verify_spreadsheet_streaming(logger, importer, fpath, metadata_info(fpath))
+    assert errors[0].startswith("E3003:")
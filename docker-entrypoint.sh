@@ -92,6 +92,15 @@ function defaults {
 
     : "${DJANGO_FIXTURES:=none}"
 
+    # the queues served by a celery worker, and the limits on its pool; an empty
+    # value leaves celery's default in place
+    : "${CELERY_QUEUES:=fast,heavy,warm}"
+    : "${CELERY_WORKER_NAME:=celery}"
+    : "${CELERY_CONCURRENCY:=}"
+    : "${CELERY_PREFETCH_MULTIPLIER:=}"
+    : "${CELERY_MAX_TASKS_PER_CHILD:=}"
+    : "${CELERY_MAX_MEMORY_PER_CHILD:=}"
+
     export DBSERVER DBPORT DBUSER DBNAME DBPASS MEMCACHE DOCKER_ROUTE
     export TEST_APP_URL TEST_APP_SCHEME TEST_APP_HOST TEST_APP_PORT TEST_APP_PATH TEST_BROWSER TEST_WAIT TEST_SELENIUM_HUB
     export DJANGO_FIXTURES
@@ -248,8 +257,23 @@ fi
 if [ "$1" = 'celery_worker' ]; then
     info "[Run] Starting celery_worker"
 
+    CELERY_OPTS=(-Q "${CELERY_QUEUES}" -n "${CELERY_WORKER_NAME}@%h")
+    if [[ "$CELERY_CONCURRENCY" ]]; then
+        CELERY_OPTS+=(--concurrency "${CELERY_CONCURRENCY}")
+    fi
+    if [[ "$CELERY_PREFETCH_MULTIPLIER" ]]; then
+        CELERY_OPTS+=(--prefetch-multiplier "${CELERY_PREFETCH_MULTIPLIER}")
+    fi
+    if [[ "$CELERY_MAX_TASKS_PER_CHILD" ]]; then
+        CELERY_OPTS+=(--max-tasks-per-child "${CELERY_MAX_TASKS_PER_CHILD}")
+    fi
+    if [[ "$CELERY_MAX_MEMORY_PER_CHILD" ]]; then
+        # KiB
+        CELERY_OPTS+=(--max-memory-per-child "${CELERY_MAX_MEMORY_PER_CHILD}")
+    fi
+
     set -x
-    exec celery -A bpaworkflow worker -l info
+    exec celery -A bpaworkflow worker -l info "${CELERY_OPTS[@]}"
 fi
 
 # runtests entrypoint
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+load test for the bpaworkflow verification API.
+
+each simulated session behaves as a browser running bpaworkflow.js: it loads
+the index page (for its session and CSRF cookies), fetches the importer
+metadata, uploads the files of a submission in chunks, submits them for
+verification, and then waits on the status of the job until it is complete,
+polling if the server doesn't wait for updates (VERIFICATION_STATUS_WAIT) or
+waiting fails. sessions run concurrently, each making a number of submissions
+in turn.
+
+latency percentiles and error rates are reported for each endpoint, and for
+whole submissions (from the start of the upload until the job is complete).
+
+identical submissions share the results of a single job, so to load the
+workers with every submission, run the server with the result cache disabled
+(VERIFICATION_RESULT_CACHE_SIZE=0), as docker-compose-loadtest.yml does.
+
+only the standard library is used, so this runs from any python 3 install:
+
+    scripts/loadtest.py --url http://localhost:9000/ --sessions 20 \\
+        --importer gap-ont-promethion \\
+        --xlsx bpaworkflow/tests/test_data/79639_GAP_AGRF_PAE47351_metadata.xlsx \\
+        --md5 bpaworkflow/tests/test_data/79639_GAP_AGRF_PAE47351_checksums.md5
+"""
+
+import argparse
+import http.cookiejar
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+from collections import defaultdict
+
+csrf_input = re.compile(r'name=["\']csrfmiddlewaretoken["\']\s+value=["\']([^"\']+)')
+
+
+class Stats:
+    "latencies and errors, by endpoint; shared by the sessions"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.error_examples = {}
+
+    def record(self, name, seconds, error=None):
+        with self.lock:
+            self.latencies[name].append(seconds)
+            if error is not None:
+                self.errors[name] += 1
+                self.error_examples.setdefault(name, error)
+
+
+def percentile(ordered, fraction):
+    "nearest-rank percentile of a sorted list"
+    if not ordered:
+        return None
+    rank = max(1, math.ceil(fraction * len(ordered)))
+    return ordered[rank - 1]
+
+
+def encode_multipart(fields, files):
+    """
+    returns (content type, body) for a multipart/form-data request; `files`
+    is a list of (field name, filename, bytes)
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            '--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(
+                boundary, name, value
+            ).encode("utf8")
+        )
+    for name, filename, content in files:
+        parts.append(
+            (
+                "--{}\r\nContent-Disposition: form-data; "
+                'name="{}"; filename="{}"\r\n'
+                "Content-Type: application/octet-stream\r\n\r\n"
+            )
+            .format(boundary, name, filename)
+            .encode("utf8")
+            + content
+            + b"\r\n"
+        )
+    parts.append("--{}--\r\n".format(boundary).encode("utf8"))
+    return "multipart/form-data; boundary={}".format(boundary), b"".join(parts)
+
+
+class RequestFailed(Exception):
+    pass
+
+
+class Session:
+    def __init__(self, options, stats):
+        self.options = options
+        self.stats = stats
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(self.cookies)
+        )
+        self.csrf_token = None
+
+    def request(self, name, path, data=None, headers={}, parse=True, timeout=None):
+        """
+        make a request, recording its latency under `name`; returns the
+        decoded JSON response, or the body if `parse` is false
+        """
+        url = urllib.parse.urljoin(self.options.url, path)
+        if isinstance(data, dict):
+            data = urllib.parse.urlencode(data).encode("utf8")
+        req = urllib.request.Request(url, data=data, headers=dict(headers))
+        # Django checks the referer of secure requests
+        req.add_header("Referer", self.options.url)
+        started = time.monotonic()
+        try:
+            with self.opener.open(req, timeout=timeout or self.options.timeout) as r:
+                body = r.read()
+            result = json.loads(body.decode("utf8")) if parse else body
+            if parse and isinstance(result, dict) and "error" in result:
+                raise RequestFailed(result["error"])
+        except (OSError, ValueError, RequestFailed) as e:
+            self.stats.record(name, time.monotonic() - started, repr(e))
+            raise RequestFailed("{}: {}".format(name, e))
+        self.stats.record(name, time.monotonic() - started)
+        return result
+
+    def start(self):
+        body = self.request("index", "", parse=False)
+        match = csrf_input.search(body.decode("utf8", "replace"))
+        if match is None:
+            raise RequestFailed("index: no CSRF token")
+        self.csrf_token = match.group(1)
+        self.request("metadata", "private/api/v1/metadata")
+
+    def upload(self, fpath):
+        "upload a file in chunks, as jquery.fileupload does; returns the upload ID"
+        with open(fpath, "rb") as fd:
+            content = fd.read()
+        name = os.path.basename(fpath)
+        status = self.request(
+            "upload",
+            "private/api/v1/upload",
+            {
+                "name": name,
+                "size": len(content),
+                "csrfmiddlewaretoken": self.csrf_token,
+            },
+        )
+        upload_id = status["upload_id"]
+        start = 0
+        chunk_size = self.options.chunk_size
+        while start < len(content):
+            chunk = content[start : start + chunk_size]
+            content_type, body = encode_multipart(
+                {"upload_id": upload_id, "csrfmiddlewaretoken": self.csrf_token},
+                [("file", name, chunk)],
+            )
+            self.request(
+                "upload",
+                "private/api/v1/upload",
+                body,
+                {
+                    "Content-Type": content_type,
+                    "Content-Range": "bytes {}-{}/{}".format(
+                        start, start + len(chunk) - 1, len(content)
+                    ),
+                },
+            )
+            start += len(chunk)
+        return upload_id
+
+    def submit(self):
+        "make a submission and wait for its results; returns the final status"
+        data = {
+            "importer": self.options.importer,
+            "csrfmiddlewaretoken": self.csrf_token,
+            "md5_upload": self.upload(self.options.md5),
+            "xlsx_upload": self.upload(self.options.xlsx),
+        }
+        submission_id = self.request("validate", "private/api/v1/validate", data)[
+            "submission_id"
+        ]
+        deadline = time.monotonic() + self.options.submission_timeout
+        version = 0
+        while time.monotonic() < deadline:
+            try:
+                status = self.request(
+                    "status_wait",
+                    "private/api/v1/status/wait",
+                    {"submission_id": submission_id, "version": version},
+                    # the server holds the request for up to VERIFICATION_STATUS_WAIT
+                    timeout=self.options.timeout + 60,
+                )
+                if (status.get("version") or 0) <= version:
+                    # the server doesn't wait for updates; poll, as the browser does
+                    time.sleep(1)
+                version = status.get("version") or version
+            except RequestFailed:
+                time.sleep(1)
+                status = self.request(
+                    "status", "private/api/v1/status", {"submission_id": submission_id}
+                )
+            if status["complete"] is not False:
+                return status
+        raise RequestFailed("submission: timed out")
+
+    def run(self, delay):
+        time.sleep(delay)
+        try:
+            self.start()
+        except RequestFailed:
+            return
+        for _ in range(self.options.submissions):
+            started = time.monotonic()
+            try:
+                self.submit()
+                self.stats.record("submission", time.monotonic() - started)
+            except RequestFailed as e:
+                self.stats.record("submission", time.monotonic() - started, str(e))
+            time.sleep(random.uniform(0, self.options.think_time))
+
+
+def report(stats, elapsed, out):
+    out.write(
+        "%-12s %7s %7s %7s %9s %9s %9s %9s %9s\n"
+        % ("endpoint", "count", "errors", "rate", "p50", "p90", "p95", "p99", "max")
+    )
+    results = {}
+    for name in sorted(stats.latencies):
+        ordered = sorted(stats.latencies[name])
+        count = len(ordered)
+        errors = stats.errors[name]
+        results[name] = row = {
+            "count": count,
+            "errors": errors,
+            "error_rate": errors / count,
+            "per_second": count / elapsed,
+        }
+        for label, fraction in (
+            ("p50", 0.5),
+            ("p90", 0.9),
+            ("p95", 0.95),
+            ("p99", 0.99),
+        ):
+            row[label] = percentile(ordered, fraction)
+        row["max"] = ordered[-1]
+        out.write(
+            "%-12s %7d %7d %6.1f%% %8.3fs %8.3fs %8.3fs %8.3fs %8.3fs\n"
+            % (
+                name,
+                count,
+                errors,
+                100.0 * row["error_rate"],
+                row["p50"],
+                row["p90"],
+                row["p95"],
+                row["p99"],
+                row["max"],
+            )
+        )
+    for name, example in sorted(stats.error_examples.items()):
+        out.write("first error for %s: %s\n" % (name, example))
+    out.write("%.1f seconds elapsed\n" % elapsed)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", default="http://localhost:9000/")
+    parser.add_argument("--importer", required=True, help="importer slug")
+    parser.add_argument("--xlsx", required=True, help="spreadsheet to submit")
+    parser.add_argument("--md5", required=True, help="MD5 file to submit")
+    parser.add_argument("--sessions", type=int, default=10, help="concurrent sessions")
+    parser.add_argument(
+        "--submissions", type=int, default=3, help="submissions made by each session"
+    )
+    parser.add_argument(
+        "--ramp-up", type=float, default=10, help="seconds over which sessions start"
+    )
+    parser.add_argument(
+        "--think-time",
+        type=float,
+        default=5,
+        help="most seconds a session waits between submissions",
+    )
+    parser.add_argument("--chunk-size", type=int, default=1 << 20)
+    parser.add_argument(
+        "--timeout", type=float, default=60, help="seconds allowed for a request"
+    )
+    parser.add_argument(
+        "--submission-timeout",
+        type=float,
+        default=1800,
+        help="seconds allowed for a submission to complete",
+    )
+    parser.add_argument("--json", help="write the results to this file")
+    options = parser.parse_args()
+    if not options.url.endswith("/"):
+        options.url += "/"
+
+    stats = Stats()
+    threads = [
+        threading.Thread(
+            target=Session(options, stats).run,
+            args=(options.ramp_up * i / options.sessions,),
+            daemon=True,
+        )
+        for i in range(options.sessions)
+    ]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results = report(stats, time.monotonic() - started, sys.stdout)
+    if options.json:
+        with open(options.json, "w") as fd:
+            json.dump(results, fd, indent=2, sort_keys=True)
+    return 1 if any(t["errors"] for t in results.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())